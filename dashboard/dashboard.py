@@ -2,23 +2,230 @@ import streamlit as st
 import plotly.express as px
 import pandas as pd
 import psycopg2
-from sqlalchemy import create_engine
-import streamlit as st
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from sqlalchemy import bindparam, create_engine, text
+from typing import NamedTuple
+import gzip
 import os
+import tempfile
 
 # Initialize connection
 @st.cache_resource
 def init_connection():
     return create_engine(os.getenv('DATABASE_URL'))
 
+# Sidebar filters, as (column, parameter name) pairs; each one is backed by an idx_survey_summary_* index
+FILTER_COLUMNS = [
+    ('district_', 'districts'),
+    ('"Quartile_"', 'quartiles'),
+    ('source_file_', 'source_files'),
+]
+
+class Filters(NamedTuple):
+    """Values selected in the sidebar, an empty tuple meaning no filter"""
+    districts: tuple = ()
+    quartiles: tuple = ()
+    source_files: tuple = ()
+
+def filter_conditions(filters, placeholder=':{}'):
+    """SQL conditions and parameters of the selected filters, ``placeholder`` formatted with each parameter name"""
+    conditions = []
+    params = {}
+    for column, name in FILTER_COLUMNS:
+        values = getattr(filters, name)
+        if values:
+            conditions.append(f"{column} IN {placeholder.format(name)}")
+            params[name] = values
+    return conditions, params
+
+def filtered_query(sql, filters, **params):
+    """Run ``sql`` with its ``{where}`` placeholder replaced by the selected filters"""
+    conditions, filter_params = filter_conditions(filters)
+    expanding = [bindparam(name, expanding=True) for name in filter_params]
+    params.update({name: list(values) for name, values in filter_params.items()})
+    statement = text(sql.format(where=' AND '.join(conditions) or 'TRUE')).bindparams(*expanding)
+    return pd.read_sql_query(statement, init_connection(), params=params)
+
+# Seconds a data version probe is reused before the database is asked again
+VERSION_PROBE_SECONDS = 5
+# Query results kept per loader, across data versions and filter selections
+CACHE_ENTRIES = 100
+
+@st.cache_data(ttl=VERSION_PROBE_SECONDS)
+def data_version():
+    """Version of the summary data, bumped by the pipeline after each load"""
+    conn = init_connection()
+    query = "SELECT version FROM metrics.data_version WHERE name = 'survey_summary'"
+    versions = pd.read_sql_query(query, conn)['version']
+    return int(versions.iloc[0]) if len(versions) else 0
+
 # Load data
-@st.cache_data(ttl=600)
-def load_data():
+# Loaders take the data version only as a cache key, so results are reused until the next load
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def load_filter_options(version):
     conn = init_connection()
+    options = {}
+    for column, name in FILTER_COLUMNS:
+        query = f"SELECT DISTINCT {column} AS value FROM metrics.survey_summary ORDER BY 1"
+        options[name] = pd.read_sql_query(query, conn)['value'].dropna().tolist()
     query = """
-    SELECT * FROM metrics.survey_summary
+    SELECT column_name, data_type FROM information_schema.columns
+    WHERE table_schema = 'metrics' AND table_name = 'survey_summary'
+    ORDER BY ordinal_position
     """
-    return pd.read_sql_query(query, conn)
+    columns = pd.read_sql_query(query, conn)
+    options['columns'] = columns['column_name'].tolist()
+    options['column_types'] = dict(zip(columns['column_name'], columns['data_type']))
+    return options
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def load_key_metrics(version, filters):
+    if filters.source_files:
+        # Rollups are per district and quartile, a source file filter needs the summary table
+        query = """
+        SELECT COUNT(DISTINCT hhid_2_nunique) AS total_households,
+               AVG(hhh_read_write_mean) AS read_write_mean,
+               AVG(assets_reported_total_mean) AS assets_mean
+        FROM metrics.survey_summary
+        WHERE {where}
+        """
+    else:
+        query = """
+        SELECT (SELECT COUNT(DISTINCT households)
+                FROM metrics.survey_kpis, unnest(household_counts) AS households
+                WHERE {where}) AS total_households,
+               SUM(read_write_sum) / NULLIF(SUM(read_write_count), 0) AS read_write_mean,
+               SUM(assets_sum) / NULLIF(SUM(assets_count), 0) AS assets_mean
+        FROM metrics.survey_kpis
+        WHERE {where}
+        """
+    return filtered_query(query, filters).iloc[0]
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def load_income_histogram(version, filters, bins=50):
+    # Values are binned in the database, only the bin counts are fetched
+    query = """
+    WITH filtered AS (
+        SELECT assets_reported_total_mean AS value
+        FROM metrics.survey_summary
+        WHERE {where} AND assets_reported_total_mean IS NOT NULL
+    ), bounds AS (
+        SELECT MIN(value) AS low, MAX(value) AS high FROM filtered
+    )
+    SELECT CASE WHEN high > low THEN LEAST(width_bucket(value, low, high, :bins), :bins) ELSE 1 END AS bin,
+           low, high, COUNT(*) AS count
+    FROM filtered, bounds
+    GROUP BY 1, low, high
+    ORDER BY 1
+    """
+    histogram = filtered_query(query, filters, bins=bins)
+    width = (histogram['high'] - histogram['low']) / bins
+    histogram['assets_reported_total_mean'] = histogram['low'] + (histogram['bin'] - 0.5) * width
+    return histogram[['assets_reported_total_mean', 'count']]
+
+@st.cache_data(max_entries=CACHE_ENTRIES)
+def load_read_write_by_district(version, filters):
+    if filters.source_files:
+        query = """
+        SELECT district_, hhh_read_write_mean, COUNT(*) AS count
+        FROM metrics.survey_summary
+        WHERE {where} AND hhh_read_write_mean IS NOT NULL
+        GROUP BY district_, hhh_read_write_mean
+        ORDER BY district_, hhh_read_write_mean
+        """
+    else:
+        query = """
+        SELECT district_, hhh_read_write_mean, SUM(count) AS count
+        FROM metrics.survey_read_write_by_district
+        WHERE {where}
+        GROUP BY district_, hhh_read_write_mean
+        ORDER BY district_, hhh_read_write_mean
+        """
+    return filtered_query(query, filters)
+
+# Export formats: file extension and MIME type
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv'),
+    'CSV (gzip)': ('csv.gz', 'application/gzip'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+# Arrow types of the PostgreSQL column types in metrics.survey_summary, anything else is exported as text
+ARROW_TYPES = {
+    'smallint': pa.int16(),
+    'integer': pa.int32(),
+    'bigint': pa.int64(),
+    'real': pa.float32(),
+    'double precision': pa.float64(),
+    'numeric': pa.float64(),
+    'boolean': pa.bool_(),
+    'date': pa.date32(),
+    'timestamp without time zone': pa.timestamp('us'),
+    'timestamp with time zone': pa.timestamp('us', tz='UTC'),
+}
+
+def quote_column(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def export_summary(columns, column_types, filters, export_format):
+    """Stream the selected columns of the filtered summary rows into a temporary file and return its path
+
+    Rows are copied out of Postgres with ``COPY ... TO STDOUT`` straight
+    into the file, so the export is never held in memory as a whole.
+    Parquet files are converted from the CSV one block at a time, with the
+    Arrow types of the table's ``column_types``.
+    """
+    extension, _ = EXPORT_FORMATS[export_format]
+    conditions, params = filter_conditions(filters, placeholder='%({})s')
+    query = (f"SELECT {', '.join(map(quote_column, columns))} FROM metrics.survey_summary "
+             f"WHERE {' AND '.join(conditions) or 'TRUE'}")
+    fd, path = tempfile.mkstemp(suffix=f".{extension}")
+    os.close(fd)
+    connection = init_connection().raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            # psycopg2 renders tuples as IN lists
+            copy_sql = cursor.mogrify(query, {name: tuple(values) for name, values in params.items()}).decode()
+            copy_sql = f"COPY ({copy_sql}) TO STDOUT WITH (FORMAT csv, HEADER)"
+            if export_format == 'CSV (gzip)':
+                with gzip.open(path, 'wb') as output:
+                    cursor.copy_expert(copy_sql, output)
+            elif export_format == 'Parquet':
+                with tempfile.TemporaryFile() as csv_file:
+                    cursor.copy_expert(copy_sql, csv_file)
+                    csv_file.seek(0)
+                    csv_to_parquet(csv_file, path, {column: column_types[column] for column in columns})
+            else:
+                with open(path, 'wb') as output:
+                    cursor.copy_expert(copy_sql, output)
+        return path
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        connection.close()
+
+def arrow_type(data_type):
+    """Arrow type of a PostgreSQL column type from information_schema"""
+    return ARROW_TYPES.get(data_type, pa.string())
+
+def csv_to_parquet(csv_file, path, column_types):
+    """Convert CSV to zstd-compressed Parquet one record batch at a time
+
+    Column types are given rather than inferred, since inference only sees
+    the first block: a column that is empty there, or whose floats happen
+    to be whole numbers, would fail on the first value that does not fit.
+    """
+    convert_options = pa_csv.ConvertOptions(
+        column_types={column: arrow_type(data_type) for column, data_type in column_types.items()},
+        # COPY writes NULL unquoted and empty strings quoted
+        strings_can_be_null=True, quoted_strings_can_be_null=False)
+    reader = pa_csv.open_csv(csv_file, convert_options=convert_options)
+    with pq.ParquetWriter(path, reader.schema, compression='zstd') as writer:
+        for batch in reader:
+            writer.write_batch(batch)
 
 
 #
@@ -27,25 +234,29 @@ st.title("RTV Household Survey Dashboard")
 
 # Sidebar filters
 st.sidebar.header("Filters")
-region = st.sidebar.selectbox("Select Region", ["All", "Region1", "Region2"])
-
-# Load data
-survey_data = load_data()
+version = data_version()
+options = load_filter_options(version)
+filters = Filters(
+    districts=tuple(st.sidebar.multiselect("Select Districts", options['districts'])),
+    quartiles=tuple(st.sidebar.multiselect("Select Quartiles", options['quartiles'])),
+    source_files=tuple(st.sidebar.multiselect("Select Source Files", options['source_files'])),
+)
 
 
 # Metrics overview
 st.header("Key Metrics")
+key_metrics = load_key_metrics(version, filters)
 col1, col2, col3 = st.columns(3)
 with col1:
-    st.metric("Total Households", survey_data['hhid_2_nunique'].nunique())
+    st.metric("Total Households", int(key_metrics['total_households']))
 with col2:
-    mean_poverty_rate = survey_data['hhh_read_write_mean'].mean()
+    mean_poverty_rate = key_metrics['read_write_mean']
     if pd.isna(mean_poverty_rate):  
         st.metric("Poverty Rate", "N/A")
     else:
         st.metric("Poverty Rate", f"{mean_poverty_rate:.2%}")
 with col3:
-    mean_average_income = survey_data['assets_reported_total_mean'].mean()
+    mean_average_income = key_metrics['assets_mean']
     if pd.isna(mean_average_income):
         st.metric("Average Income", "N/A")
     else:
@@ -55,17 +266,18 @@ with col3:
 st.header("Trend Analysis")
 
 # Income distribution
-fig_income = px.histogram(
-    survey_data,
+fig_income = px.bar(
+    load_income_histogram(version, filters),
     x="assets_reported_total_mean",
-    nbins=50,
+    y="count",
     title="Household Income Distribution"
 )
+fig_income.update_layout(bargap=0)
 st.plotly_chart(fig_income)
 
 # Poverty status by region
 fig_poverty = px.bar(
-    survey_data.groupby(['district_', 'hhh_read_write_mean']).size().reset_index(name='count'),
+    load_read_write_by_district(version, filters),
     x='district_',
     y='count',
     color='hhh_read_write_mean',
@@ -74,13 +286,28 @@ fig_poverty = px.bar(
 st.plotly_chart(fig_poverty)
 
 # Download data
-@st.cache_data
-def convert_df(df):
-    return df.to_csv().encode('utf-8')
-
-st.download_button(
-    label="Download data as CSV",
-    data=convert_df(survey_data),
-    file_name='survey_data.csv',
-    mime='text/csv',
-)
+# The file is only generated when asked for, from the filters in the sidebar
+st.header("Export")
+with st.form("export"):
+    export_columns = st.multiselect("Columns", options['columns'], default=options['columns'])
+    export_format = st.selectbox("Format", list(EXPORT_FORMATS))
+    prepare_export = st.form_submit_button("Prepare export")
+
+if prepare_export:
+    if not export_columns:
+        st.warning("Select at least one column to export")
+    else:
+        columns = [column for column in options['columns'] if column in export_columns]
+        with st.spinner("Exporting survey data..."):
+            path = export_summary(columns, options['column_types'], filters, export_format)
+        try:
+            extension, mime = EXPORT_FORMATS[export_format]
+            with open(path, 'rb') as data:
+                st.download_button(
+                    label=f"Download data as {export_format}",
+                    data=data,
+                    file_name=f'survey_data.{extension}',
+                    mime=mime,
+                )
+        finally:
+            os.remove(path)
@@ -38,6 +38,66 @@ CREATE INDEX IF NOT EXISTS idx_survey_summary_district ON metrics.survey_summary
 CREATE INDEX IF NOT EXISTS idx_survey_summary_quartile ON metrics.survey_summary("Quartile_");
 CREATE INDEX IF NOT EXISTS idx_survey_summary_source_file ON metrics.survey_summary(source_file_);
 
+-- Dashboard rollups per district and quartile, refreshed by the pipeline after each load.
+-- The unique indexes let them be refreshed concurrently. The pipeline creates them and the
+-- data_version table below on databases that predate them (load.DASHBOARD_SCHEMA), keep both in sync.
+CREATE MATERIALIZED VIEW IF NOT EXISTS metrics.survey_kpis AS
+SELECT district_,
+    "Quartile_",
+    array_agg(DISTINCT hhid_2_nunique) FILTER (WHERE hhid_2_nunique IS NOT NULL) AS household_counts,
+    SUM(hhh_read_write_mean) AS read_write_sum,
+    COUNT(hhh_read_write_mean) AS read_write_count,
+    SUM(assets_reported_total_mean) AS assets_sum,
+    COUNT(assets_reported_total_mean) AS assets_count
+FROM metrics.survey_summary
+GROUP BY district_, "Quartile_";
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_survey_kpis_key ON metrics.survey_kpis(district_, "Quartile_");
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS metrics.survey_read_write_by_district AS
+SELECT district_,
+    "Quartile_",
+    hhh_read_write_mean,
+    COUNT(*) AS count
+FROM metrics.survey_summary
+WHERE hhh_read_write_mean IS NOT NULL
+GROUP BY district_, "Quartile_", hhh_read_write_mean;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_survey_read_write_by_district_key
+    ON metrics.survey_read_write_by_district(district_, "Quartile_", hhh_read_write_mean);
+
+-- Version of the summary data, bumped by the pipeline after each load and its rollup refresh.
+-- The dashboard caches query results per version.
+CREATE TABLE IF NOT EXISTS metrics.data_version (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO metrics.data_version (name) VALUES ('survey_summary') ON CONFLICT DO NOTHING;
+
+-- Create pipeline_jobs table, shared by every pipeline process
+CREATE TABLE IF NOT EXISTS pipeline_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    status VARCHAR(20) NOT NULL,
+    message TEXT,
+    survey_year VARCHAR(20),
+    bucket TEXT,
+    prefix TEXT NOT NULL DEFAULT '',
+    start_time TIMESTAMP,
+    end_time TIMESTAMP,
+    duration_seconds FLOAT,
+    metrics JSON,
+    checkpoints JSON,
+    requested_action VARCHAR(20),
+    owner VARCHAR(200),
+    heartbeat TIMESTAMP
+);
+
 -- Grant permissions
 GRANT ALL PRIVILEGES ON SCHEMA metrics TO rtv_test_user;
 GRANT ALL PRIVILEGES ON TABLE metrics.survey_summary TO rtv_test_user;
+GRANT ALL PRIVILEGES ON TABLE metrics.survey_kpis TO rtv_test_user;
+GRANT ALL PRIVILEGES ON TABLE metrics.survey_read_write_by_district TO rtv_test_user;
+GRANT ALL PRIVILEGES ON TABLE metrics.data_version TO rtv_test_user;
+GRANT ALL PRIVILEGES ON TABLE pipeline_jobs TO rtv_test_user;
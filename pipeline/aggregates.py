@@ -0,0 +1,293 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional, Tuple
+from sketches import DEFAULT_HLL_PRECISION, hll_estimate, hll_merge, hll_registers
+
+# Aggregation name for the most common value of a column. Its output columns
+# keep the "<lambda>" suffix of the original lambda-based aggregation, which
+# the metrics.survey_summary schema depends on.
+MODE = 'mode'
+MODE_LABEL = '<lambda>'
+
+# Aggregations that PartialAggregates can compute and merge
+SUPPORTED_AGGREGATIONS = {'count', 'sum', 'mean', 'min', 'max', 'median', 'nunique', MODE}
+# Exact state or a bounded-size sketch for medians and distinct counts
+SKETCH_MODES = ('exact', 'approx')
+
+def number_groups(frame: pd.DataFrame, keys: List[str]) -> Tuple[np.ndarray, pd.DataFrame]:
+    """Number the groups of ``keys`` in sorted key order
+
+    Returns the group id of every row (-1 for rows with a missing key) and a
+    frame with the key values of each group id.
+    """
+    if not keys:
+        return np.zeros(len(frame), dtype=np.int64), pd.DataFrame(index=range(1 if len(frame) else 0))
+
+    grouped = frame.groupby(keys, observed=True, sort=False)
+    # Rows with a missing key get a NaN group number, which makes the array float
+    codes = np.nan_to_num(grouped.ngroup().to_numpy(dtype='float64'), nan=-1).astype(np.int64)
+    groups = grouped.size().index.to_frame(index=False)
+    # Unsorted groupbys reorder categories by appearance, restore the original order
+    for key in keys:
+        if isinstance(frame[key].dtype, pd.CategoricalDtype):
+            groups[key] = groups[key].cat.set_categories(frame[key].cat.categories)
+    # Observed groupbys over categoricals do not reliably sort, so rank the groups explicitly
+    order = groups.sort_values(keys, kind='mergesort').index.to_numpy()
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    # Only rows in a group are ranked, a frame may have no complete keys at all
+    valid = codes >= 0
+    codes[valid] = rank[codes[valid]]
+    return codes, groups.iloc[order].reset_index(drop=True)
+
+def _count_values(gids: np.ndarray, values, counts: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Count (group id, value) pairs, sorted by group id then value
+
+    Values are factorized in sorted order and combined with the group id into a
+    single integer key, so counting and sorting is one pass over an int64 array.
+    """
+    codes, uniques = pd.factorize(values, sort=True)
+    valid = (gids >= 0) & (codes >= 0)
+    width = max(len(uniques), 1)
+    keys = gids[valid].astype(np.int64) * width + codes[valid]
+    if counts is None:
+        keys, key_counts = np.unique(keys, return_counts=True)
+    else:
+        keys, inverse = np.unique(keys, return_inverse=True)
+        key_counts = np.bincount(inverse, weights=counts[valid], minlength=len(keys)).astype(np.int64)
+    return pd.DataFrame({'_gid': keys // width, 'value': uniques.take(keys % width),
+                         '_count': key_counts})
+
+def _mode_from_counts(counted: pd.DataFrame, n_groups: int) -> pd.Series:
+    """Most common value per group id; ties go to the smallest value"""
+    gids = counted['_gid'].to_numpy()
+    counts = counted['_count'].to_numpy()
+    max_counts = counted.groupby('_gid', sort=False)['_count'].transform('max').to_numpy()
+    candidates = np.flatnonzero(counts == max_counts)
+    # Values are sorted within each group, so the first candidate is the smallest value
+    present, first = np.unique(gids[candidates], return_index=True)
+    modes = counted['value'].iloc[candidates[first]]
+    return pd.Series(modes.values, index=present).reindex(range(n_groups))
+
+def _median_from_counts(counted: pd.DataFrame, n_groups: int) -> np.ndarray:
+    """Exact median per group id from sorted (group id, value) counts"""
+    result = np.full(n_groups, np.nan)
+    if counted.empty:
+        return result
+    gids = counted['_gid'].to_numpy()
+    values = counted['value'].to_numpy(dtype='float64')
+    running = np.cumsum(counted['_count'].to_numpy())
+    present, starts = np.unique(gids, return_index=True)
+    ends = np.append(starts[1:], len(gids)) - 1
+    offsets = np.where(starts > 0, running[np.maximum(starts - 1, 0)], 0)
+    totals = running[ends] - offsets
+    # The median averages the values at 0-based positions (n - 1) // 2 and n // 2;
+    # the value at position p is on the first row whose running count exceeds p
+    lower = values[np.searchsorted(running, offsets + (totals - 1) // 2, side='right')]
+    upper = values[np.searchsorted(running, offsets + totals // 2, side='right')]
+    result[present] = (lower + upper) / 2
+    return result
+
+class PartialAggregates:
+    """Mergeable aggregate state for a metric spec at one grouping level
+
+    ``spec`` maps each column to a list of aggregations from
+    ``SUPPORTED_AGGREGATIONS``. Counts, sums, minima and maxima are kept per
+    group; medians, distinct counts and modes keep per-group value counts.
+    Partials can be merged with partials of the same keys (e.g. computed on
+    separate files or chunks) and rolled up to any subset of their keys,
+    including no keys at all, without rescanning raw rows. Means are derived
+    exactly from sum and count.
+
+    ``median='exact'`` keeps the full value distribution of median columns;
+    ``median='approx'`` rounds values to ``median_precision`` decimals first,
+    which bounds the state size at the cost of that much error.
+    ``distinct='exact'`` keeps every distinct value; ``distinct='approx'``
+    keeps a HyperLogLog sketch of ``2 ** distinct_precision`` bytes per group.
+    """
+
+    def __init__(self, keys: List[str], spec: Dict[str, List[str]], median: str = 'exact',
+                 median_precision: int = 1, distinct: str = 'exact',
+                 distinct_precision: int = DEFAULT_HLL_PRECISION):
+        if median not in SKETCH_MODES:
+            raise ValueError(f"median must be one of {SKETCH_MODES}, got {median!r}")
+        if distinct not in SKETCH_MODES:
+            raise ValueError(f"distinct must be one of {SKETCH_MODES}, got {distinct!r}")
+        for col, aggs in spec.items():
+            unsupported = set(aggs) - SUPPORTED_AGGREGATIONS
+            if unsupported:
+                raise ValueError(f"Unsupported aggregations for {col}: {sorted(unsupported)}")
+
+        self.keys = list(keys)
+        self.spec = spec
+        self.median = median
+        self.median_precision = median_precision
+        self.distinct = distinct
+        self.distinct_precision = distinct_precision
+        # Key values of each group, the row number is the group id
+        self.groups = pd.DataFrame(columns=self.keys)
+        # Per-group counts, sums, minima and maxima with (column, stat) columns
+        self.stats = pd.DataFrame()
+        # Per-group (value, count) pairs for modes, exact distinct counts and medians
+        self.value_counts: Dict[str, pd.DataFrame] = {}
+        # Per-group (rounded value, count) pairs for approximate medians
+        self.binned_counts: Dict[str, pd.DataFrame] = {}
+        # Per-group HyperLogLog registers for approximate distinct counts
+        self.distinct_sketches: Dict[str, np.ndarray] = {}
+
+    def _derive(self, keys: List[str]) -> 'PartialAggregates':
+        """Empty partials with the same spec and options at another grouping level"""
+        return PartialAggregates(keys, self.spec, self.median, self.median_precision,
+                                 self.distinct, self.distinct_precision)
+
+    @staticmethod
+    def _base_stats(aggs: List[str]) -> List[str]:
+        stats = []
+        if 'count' in aggs or 'mean' in aggs:
+            stats.append('count')
+        if 'sum' in aggs or 'mean' in aggs:
+            stats.append('sum')
+        stats.extend(stat for stat in ('min', 'max') if stat in aggs)
+        return stats
+
+    def _needs_value_counts(self, aggs: List[str]) -> bool:
+        return (MODE in aggs or ('nunique' in aggs and self.distinct == 'exact')
+                or ('median' in aggs and self.median == 'exact'))
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, keys: List[str], spec: Dict[str, List[str]],
+                   **options) -> 'PartialAggregates':
+        """Compute partial aggregates of ``df`` grouped by ``keys``
+
+        ``options`` are the median and distinct settings of the constructor.
+        """
+        partials = cls(keys, spec, **options)
+        gids, partials.groups = number_groups(df, keys)
+        n_groups = len(partials.groups)
+        grouped = df.groupby(gids)
+        stats = pd.DataFrame({('__rows', 'count'): grouped.size()})
+        base_stats = {col: cls._base_stats(aggs) for col, aggs in spec.items()}
+        base_stats = {col: col_stats for col, col_stats in base_stats.items() if col_stats}
+        if base_stats:
+            stats = stats.join(grouped.agg(base_stats))
+        partials.stats = stats.drop(index=-1, errors='ignore')
+
+        for col, aggs in spec.items():
+            if partials._needs_value_counts(aggs):
+                partials.value_counts[col] = _count_values(gids, df[col].values)
+            if 'median' in aggs and partials.median == 'approx':
+                partials.binned_counts[col] = _count_values(
+                    gids, df[col].round(partials.median_precision).values)
+            if 'nunique' in aggs and partials.distinct == 'approx':
+                partials.distinct_sketches[col] = hll_registers(
+                    gids, df[col].values, n_groups, partials.distinct_precision)
+        return partials
+
+    def _combine(self, parts: List['PartialAggregates'], keys: List[str]) -> 'PartialAggregates':
+        """Re-aggregate the state of ``parts`` at the grouping level ``keys``"""
+        combined = self._derive(keys)
+        groups = pd.concat([part.groups[keys] for part in parts], ignore_index=True)
+        codes, combined.groups = number_groups(groups, keys)
+        n_groups = len(combined.groups)
+        # Map each part's group ids onto the combined group ids
+        offsets = np.cumsum([0] + [len(part.groups) for part in parts])
+        remaps = [codes[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+        stats = pd.concat([part.stats for part in parts])
+        # Counts and sums add up, minima and maxima merge with themselves
+        merge_funcs = {(col, stat): ('sum' if stat in ('count', 'sum') else stat)
+                       for col, stat in stats.columns}
+        # Stats of an empty frame have an object index
+        stats_gids = np.concatenate([remap[part.stats.index.to_numpy(dtype=np.int64)]
+                                     for remap, part in zip(remaps, parts)])
+        combined.stats = stats.groupby(stats_gids).agg(merge_funcs)
+
+        for attr in ('value_counts', 'binned_counts'):
+            for col in getattr(self, attr):
+                counted = [getattr(part, attr)[col] for part in parts]
+                getattr(combined, attr)[col] = _count_values(
+                    np.concatenate([remap[c['_gid'].to_numpy()] for remap, c in zip(remaps, counted)]),
+                    pd.concat([c['value'] for c in counted], ignore_index=True).values,
+                    np.concatenate([c['_count'].to_numpy() for c in counted]))
+
+        for col in self.distinct_sketches:
+            combined.distinct_sketches[col] = hll_merge(
+                np.concatenate([part.distinct_sketches[col] for part in parts]), codes, n_groups)
+        return combined
+
+    def merge(self, *others: 'PartialAggregates') -> 'PartialAggregates':
+        """Merge with partials of the same keys computed over other rows"""
+        for other in others:
+            if other.keys != self.keys or other.spec != self.spec:
+                raise ValueError("Only partials with the same keys and spec can be merged")
+        return self._combine([self, *others], self.keys)
+
+    @classmethod
+    def merge_all(cls, parts: List['PartialAggregates']) -> Optional['PartialAggregates']:
+        """Merge a list of partials with the same keys, or None if it is empty"""
+        if not parts:
+            return None
+        return parts[0].merge(*parts[1:])
+
+    def rollup(self, keys: List[str]) -> 'PartialAggregates':
+        """Aggregate to a coarser grouping level made of a subset of the keys"""
+        missing = [key for key in keys if key not in self.keys]
+        if missing:
+            raise ValueError(f"Cannot roll up to keys not in {self.keys}: {missing}")
+        return self._combine([self], list(keys))
+
+    def finalize(self) -> pd.DataFrame:
+        """Compute the final metrics, one row per group with flattened column names"""
+        n_groups = len(self.groups)
+        stats = self.stats.reindex(range(n_groups))
+        # Key columns get the trailing underscore of flattened (key, '') columns
+        result = self.groups.rename(columns={key: f"{key}_" for key in self.keys})
+        for col, aggs in self.spec.items():
+            for agg in aggs:
+                if agg in ('count', 'sum'):
+                    value = stats[(col, agg)].to_numpy()
+                    if value.dtype.kind in 'iu':
+                        # Sums of small integer columns keep the column's dtype and could overflow it
+                        value = value.astype(np.int64)
+                elif agg in ('min', 'max'):
+                    value = stats[(col, agg)].to_numpy()
+                elif agg == 'mean':
+                    count = stats[(col, 'count')]
+                    value = (stats[(col, 'sum')] / count.where(count > 0)).to_numpy()
+                elif agg == 'median':
+                    counts = (self.value_counts if self.median == 'exact' else self.binned_counts)[col]
+                    value = _median_from_counts(counts, n_groups)
+                elif agg == 'nunique' and self.distinct == 'approx':
+                    value = hll_estimate(self.distinct_sketches[col])
+                elif agg == 'nunique':
+                    value = np.bincount(self.value_counts[col]['_gid'].to_numpy(), minlength=n_groups)
+                else:
+                    value = _mode_from_counts(self.value_counts[col], n_groups).values
+                result[f"{col}_{MODE_LABEL if agg == MODE else agg}"] = value
+        return result
+
+class PartialsAccumulator:
+    """Merge a stream of partials with the same keys in balanced batches
+
+    Merging every new chunk into one running total re-copies the whole state
+    each time. Partials are instead kept on a stack where each entry covers
+    twice as many chunks as the one above it, so every chunk is merged only
+    O(log n) times.
+    """
+
+    def __init__(self):
+        self._stack: List[Tuple[int, PartialAggregates]] = []
+
+    def add(self, partials: Optional[PartialAggregates]):
+        if partials is None:
+            return
+        size = 1
+        while self._stack and self._stack[-1][0] == size:
+            previous_size, previous = self._stack.pop()
+            partials = previous.merge(partials)
+            size += previous_size
+        self._stack.append((size, partials))
+
+    def result(self) -> Optional[PartialAggregates]:
+        """All partials added so far merged into one, or None if there were none"""
+        return PartialAggregates.merge_all([partials for _, partials in self._stack])
@@ -1,12 +1,23 @@
-from flask import Flask, Blueprint, flash, render_template, request, url_for, redirect
+from flask import Flask, Blueprint, Response, flash, jsonify, render_template, request, url_for, redirect
 from werkzeug.exceptions import abort
 from datetime import datetime
-from threading import Thread, Event
-from typing import Optional
+from threading import Thread, Event, Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+import atexit
+import json
 import logging
+import os
+import re
 import pandas as pd
 
+from events import ChangeFeed
 from extract import DataExtractor
+from instrumentation import render_prometheus
+from jobstore import RECORD_FIELDS, JobStore, StageCheckpoints
+from load import ensure_dashboard_schema
+from resources import ResourceRegistry
+from scheduler import PipelineScheduler, Stage, run_stages
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'rtv_test_secret_key_here'
@@ -29,39 +40,122 @@ console_handler.setFormatter(
 )
 logger.addHandler(console_handler)
 
+# Statuses of jobs that still hold a worker or are waiting for one
+ACTIVE_STATUSES = ('Queued', 'Running', 'Paused', 'Cancelling')
+DEFAULT_SURVEY_YEAR = '2021'
+
+def prefixes_overlap(bucket_a: str, prefix_a: str, bucket_b: str, prefix_b: str) -> bool:
+    """True if two bucket prefixes share any object or result row"""
+    return bucket_a == bucket_b and (prefix_a.startswith(prefix_b) or prefix_b.startswith(prefix_a))
+
 class PipelineJob(DataExtractor):
-    def __init__(self, id: str, status: str, message: str, start_time=None):
-        super().__init__()
+    # Stage outputs saved for resuming. The extracted survey frame is not one
+    # of them: it is as large as the input and is read back from the Parquet
+    # cache instead, while the transform output is a few rows per group.
+    SAVED_OUTPUTS = ('transform',)
+
+    def __init__(self, id: str, status: str, message: str, start_time=None,
+                 resources: Optional[ResourceRegistry] = None,
+                 survey_year: str = DEFAULT_SURVEY_YEAR,
+                 bucket_name: Optional[str] = None,
+                 source_prefix: str = '',
+                 stage_executor: Optional[ThreadPoolExecutor] = None,
+                 on_change: Optional[Callable] = None,
+                 checkpoints: Optional[StageCheckpoints] = None,
+                 completed_stages: Iterable[str] = (),
+                 on_checkpoint: Optional[Callable] = None,
+                 on_finish: Optional[Callable] = None,
+                 submit: Optional[Callable] = None):
+        super().__init__(resources)
         self.id = id
+        # Called with the job id whenever the status or message changes
+        self.on_change = on_change
         self.status = status
         self.message = message
         self.start_time = start_time or datetime.now()
         self.pause_time: Optional[datetime] = None
         self.end_time: Optional[datetime] = None
-        self.thread: Optional[Thread] = None
+        self.future: Optional[Future] = None
+        # Called with the job to queue its run; a job paused before it starts is
+        # held off the queue instead, so it never occupies a pipeline worker
+        self.submit = submit
+        self.held = False
+        self.cancel_requested = False
+        # Label only, the bucket and prefix select the data a job processes
+        self.survey_year = survey_year
+        if bucket_name:
+            self.bucket_name = bucket_name
+        self.source_prefix = source_prefix
+        # Shared pool for the job's stages, a private one is used when unset
+        self.stage_executor = stage_executor
+        # Stage outputs saved as they finish, so a restarted run skips those stages
+        self.checkpoints = checkpoints
+        self.completed_stages: List[str] = list(completed_stages)
+        # Called with the job id after each checkpoint, and with the job once its run ends
+        self.on_checkpoint = on_checkpoint
+        self.on_finish = on_finish
 
-    def start(self):
-        """Start the pipeline in a background thread"""
-        if self.thread and self.thread.is_alive():
-            logger.warning(f"Pipeline {self.id} is already running")
-            return
+    @property
+    def status(self) -> str:
+        return self._status
+
+    @status.setter
+    def status(self, value: str):
+        changed = getattr(self, '_status', None) != value
+        self._status = value
+        if changed and self.on_change:
+            self.on_change(self.id)
+
+    @property
+    def message(self) -> str:
+        return self._message
+
+    @message.setter
+    def message(self, value: str):
+        changed = getattr(self, '_message', None) != value
+        self._message = value
+        if changed and self.on_change:
+            self.on_change(self.id)
+
+    @property
+    def is_active(self) -> bool:
+        """True while the job is queued, held while paused, or its run has not finished"""
+        return self.held or (self.future is not None and not self.future.done())
+
+    def queue(self):
+        """Queue the job's run, or hold it until resumed if the job is paused"""
+        self.held = self.paused_event.is_set()
+        if not self.held:
+            self.future = self.submit(self)
 
-        self.thread = Thread(target=self.run_pipeline, daemon=True)
-        self.thread.start()
-        logger.info(f"Started pipeline thread {self.id}")
+    def overlaps(self, bucket_name: str, source_prefix: str) -> bool:
+        """True if the job reads objects, or owns result rows, under the given prefix"""
+        return prefixes_overlap(self.bucket_name, self.source_prefix, bucket_name, source_prefix)
 
     def pause(self):
-        """Pause the entire pipeline"""
+        """Pause the entire pipeline, unless it is being stopped"""
+        if self.stop_event.is_set():
+            return
         self.pause_time = datetime.now()
         super().pause()
+        # A queued run gives up its place, resuming queues it again
+        if self.future is not None and self.future.cancel():
+            self.held = True
         logger.info(f"Pipeline {self.id} paused")
 
     def resume(self):
-        """Resume the entire pipeline"""
-        self.status = "Running"
-        self.message = "Pipeline resumed"
+        """Resume the entire pipeline, unless it is being stopped"""
+        if self.stop_event.is_set():
+            return
         self.pause_time = None
         super().resume()
+        if self.held:
+            self.status = "Queued"
+            self.message = "Waiting for a free pipeline worker..."
+            self.queue()
+        else:
+            self.status = "Running"
+            self.message = "Pipeline resumed"
         logger.info(f"Pipeline {self.id} resumed")
 
     def stop(self):
@@ -69,97 +163,382 @@ class PipelineJob(DataExtractor):
         super().stop()
         logger.info(f"Pipeline {self.id} stopped")
 
+    def _extract_stage(self, results: dict):
+        if self.streaming_transform:
+            # Stream files chunk by chunk into partial aggregates
+            self.message = "Streaming survey data..."
+            return self.extract_survey_partials()
+        # Load data
+        self.message = "Loading survey data..."
+        return self.extract_survey_data()
+
+    def _transform_stage(self, results: dict):
+        self.message = "Transforming data..."
+        if self.streaming_transform:
+            return self.transform_partials(results['extract'])
+        return self.transform_survey_data(results['extract'])
+
+    def _minio_stage(self, name: str):
+        def load(results: dict):
+            self.message = "Loading to MinIO and database..."
+            self.load_to_minio(results['transform'][name], survey_year=self.survey_year,
+                               object_name=self.results_object_name(name))
+        return load
+
+    def _database_stage(self, results: dict):
+        self.message = "Loading to MinIO and database..."
+        self.load_to_database(results['transform']['detailed_metrics'], survey_year=self.survey_year,
+                              scope_prefix=self.source_prefix)
+
+    def pipeline_stages(self) -> Dict[str, Stage]:
+        """Stage DAG of a run: both uploads and the database load start once transform finishes"""
+        return {
+            'extract': Stage(self._extract_stage),
+            'transform': Stage(self._transform_stage, after=('extract',)),
+            'minio_detailed': Stage(self._minio_stage('detailed_metrics'), after=('transform',)),
+            'minio_overall': Stage(self._minio_stage('overall_metrics'), after=('transform',)),
+            'database': Stage(self._database_stage, after=('transform',)),
+        }
+
+    def results_object_name(self, name: str) -> str:
+        """Results keep the job's source prefix, so jobs on different prefixes do not overwrite each other"""
+        return self.source_prefix + super().results_object_name(name)
+
+    def restore_checkpoints(self, stages: Dict[str, Stage]) -> Dict[str, object]:
+        """Results of the stages an earlier run completed
+
+        A completed stage whose output is needed by a stage still to run, but
+        whose checkpoint file is missing, is run again.
+        """
+        completed = [name for name in self.completed_stages if name in stages]
+        while True:
+            needed = {dep for name, stage in stages.items() if name not in completed
+                      for dep in stage.after if dep in completed}
+            missing = {name for name in needed if self.checkpoints is None or not self.checkpoints.has(name)}
+            if not missing:
+                break
+            completed = [name for name in completed if name not in missing]
+        self.completed_stages = completed
+        return {name: self.checkpoints.load(name) if name in needed else None for name in completed}
+
+    def _checkpoint(self, name: str, result):
+        """Record a finished stage before any stage depending on it starts
+
+        Only outputs in ``SAVED_OUTPUTS`` are written to disk; a resumed run
+        repeats other completed stages when a later stage needs their output.
+        """
+        if self.checkpoints is not None and name in self.SAVED_OUTPUTS:
+            self.checkpoints.save(name, result)
+        self.completed_stages.append(name)
+        if self.on_checkpoint:
+            self.on_checkpoint(self.id)
+
     def run_pipeline(self):
         try:
-            self.status = "Running"
+            # A job paused while queued starts paused
+            self.status = "Paused" if self.paused_event.is_set() else "Running"
             self.message = "Starting data processing..."
-            
-            # Load data
-            self.message = "Loading survey data..."
-            df = self.extract_survey_data()
-            
-            # Transform data
-            self.message = "Transforming data..."
-            transformed_data = self.transform_survey_data(df)
-            
-            # Load to MinIO
-            self.message = "Loading to MinIO..."
-            
-            # Load both detailed and overall metrics
-            self.wait_for_resume()
-            self.load_to_minio(transformed_data['detailed_metrics'], survey_year='2021', object_name='detailed_metrics.csv')
+            if not self.completed_stages:
+                # Time spent queued, paused or not, is not part of the run
+                self.start_time = datetime.now()
+                self.metrics.restart_pause_clock()
             self.wait_for_resume()
-            self.load_to_minio(transformed_data['overall_metrics'], survey_year='2021', object_name='overall_metrics.csv')
-            
-            # Load to database
-            self.message = "Loading to database..."
-            self.wait_for_resume()
-            self.load_to_database(transformed_data['detailed_metrics'], survey_year='2021')
-            
+
+            stages = self.pipeline_stages()
+            completed = self.restore_checkpoints(stages)
+            if completed:
+                logger.info(f"Pipeline {self.id} resuming after stages {', '.join(completed)}")
+            run_stages(stages, self.stage_executor, completed=completed, on_complete=self._checkpoint)
+
+            self.end_time = datetime.now()
             self.status = "Completed"
             self.message = "Pipeline completed successfully"
-            self.end_time = datetime.now()
             logger.info(f"Pipeline {self.id} completed successfully")
         except KeyboardInterrupt:
-            logger.info(f"Pipeline {self.id} stopped by user")
-            self.status = "Stopped"
-            self.message = "Pipeline stopped by user"
+            self._finish_stopped()
         except Exception as e:
+            if self.stop_event.is_set():
+                # The error came from interrupting work in flight
+                self._finish_stopped()
+                return
             logger.error(f"Pipeline failed: {str(e)}")
+            self.end_time = datetime.now()
             self.status = "Failed"
             self.message = f"Pipeline failed: {str(e)}"
             logger.error(f"Pipeline {self.id} failed: {str(e)}")
         finally:
             super().stop()
+            if self.checkpoints is not None:
+                self.checkpoints.clear()
+            if self.on_finish:
+                self.on_finish(self)
 
-    def cancel(self):
-        """Cancel the pipeline"""
-        self.status = "Cancelled"
-        self.message = "Pipeline cancelled"
+    def _finish_stopped(self):
+        """Record the end of a run that drained after a stop or cancel"""
         self.end_time = datetime.now()
-        
-        # Set stop event to signal thread to stop
-        self.stop_event.set()
-        
-        # Wait for thread to finish
-        if self.thread and self.thread.is_alive():
-            self.thread.join()
-            self.thread = None
-        
-        logger.info(f"Pipeline {self.id} cancelled")
+        if self.cancel_requested:
+            self.status = "Cancelled"
+            self.message = "Pipeline cancelled"
+            logger.info(f"Pipeline {self.id} cancelled")
+        else:
+            self.status = "Stopped"
+            self.message = "Pipeline stopped by user"
+            logger.info(f"Pipeline {self.id} stopped by user")
+
+    def cancel(self):
+        """Request cancellation and return immediately
+
+        The job reports "Cancelling" until its thread reaches the next
+        checkpoint or its interrupted call returns, then "Cancelled".
+        """
+        self.cancel_requested = True
+        # A queued or held job is dropped before it starts
+        dequeued = self.held or (self.future is not None and self.future.cancel())
+        self.held = False
+        if not dequeued and not self.is_active and self.status not in ACTIVE_STATUSES:
+            # A finished job keeps its final status
+            return
+        if dequeued or not self.is_active:
+            self.end_time = self.end_time or datetime.now()
+            self.status = "Cancelled"
+            self.message = "Pipeline cancelled"
+            logger.info(f"Pipeline {self.id} cancelled")
+            if dequeued:
+                # The run that would have cleaned up never starts
+                if self.checkpoints is not None:
+                    self.checkpoints.clear()
+                if self.on_finish:
+                    self.on_finish(self)
+            return
+
+        self.status = "Cancelling"
+        self.message = "Cancelling, waiting for the current step to stop..."
+        # Signal the thread to stop and interrupt blocking calls in flight
+        self.stop()
+        logger.info(f"Pipeline {self.id} cancellation requested")
 
     @property
     def duration(self):
-        """Return the duration of the job in seconds"""
-        if self.status == 'Running':
-            return (datetime.now() - self.start_time).total_seconds()
-        elif self.status == 'Paused':
-            if self.pause_time:
-                return (self.pause_time - self.start_time).total_seconds()
-            return 0
-        else:  # Completed, Failed, Cancelled
-            if self.end_time:
-                return (self.end_time - self.start_time).total_seconds()
+        """Return the run time of the job in seconds, excluding time spent paused"""
+        if self.status == 'Queued':
             return 0
+        end_time = self.end_time or datetime.now()
+        return max((end_time - self.start_time).total_seconds() - self.metrics.paused_seconds(), 0)
+
+    def summary(self) -> dict:
+        """JSON-serializable status of the job, as shown in job lists"""
+        return {
+            'id': self.id,
+            'status': self.status,
+            'message': self.message,
+            'survey_year': self.survey_year,
+            'bucket': self.bucket_name,
+            'prefix': self.source_prefix,
+            'start_time': self.start_time.isoformat(),
+            'end_time': self.end_time.isoformat() if self.end_time else None,
+            'duration_seconds': round(self.duration, 3),
+        }
+
+    def to_dict(self) -> dict:
+        """JSON-serializable status and per-stage metrics of the job"""
+        return {**self.summary(), **self.metrics.to_dict()}
 
 class PipelineManager:
     def __init__(self):
+        # Jobs queued or running in this process; finished jobs live only in the store
         self.jobs = {}
-        
-    def create_job(self):
-        job_id = len(self.jobs) + 1
+        self._lock = Lock()
+        # Job status changes, streamed to the web page
+        self.changes = ChangeFeed()
+        # Database and MinIO pools shared by every job this manager runs
+        self.resources = ResourceRegistry()
+        # Job records, written through a pool of their own
+        self.store = JobStore(self.resources.job_store_engine)
+        self.store.ensure_schema()
+        # Databases created before the dashboard rollups need them added
+        ensure_dashboard_schema(self.resources.engine)
+        # Stage outputs of unfinished jobs
+        self.checkpoint_dir = os.path.join(os.getenv('PIPELINE_CACHE_DIR', '.cache'), 'checkpoints')
+        # Seconds between heartbeats of owned jobs, and without one before a job is taken over
+        self.heartbeat_interval = float(os.getenv('JOB_HEARTBEAT_SECONDS', '5'))
+        self.stale_after = float(os.getenv('JOB_STALE_SECONDS', '60'))
+        # Each running job holds at most one connection of the shared pool, so
+        # never run more jobs than it can serve
+        max_jobs = int(os.getenv('PIPELINE_WORKERS', '2'))
+        db_connections = self.resources.db_pool_size + self.resources.db_max_overflow
+        if max_jobs > db_connections:
+            logger.warning(f"PIPELINE_WORKERS={max_jobs} exceeds the {db_connections} database "
+                           f"connections available, running at most {db_connections} jobs")
+            max_jobs = db_connections
+        # Every job runs up to three load stages at once
+        self.scheduler = PipelineScheduler(max_jobs=max_jobs, stage_workers=3 * max_jobs)
+        self._stopping = Event()
+        # Jobs a previous run of this process left unfinished are resumed at once
+        self.recover_jobs(include_own=True)
+        self._heartbeat_thread = Thread(target=self._heartbeat_loop, daemon=True, name='job-heartbeat')
+        self._heartbeat_thread.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        """Drop queued jobs, wait for running ones and release shared resources"""
+        self._stopping.set()
+        self.scheduler.shutdown()
+        self.resources.dispose()
+
+    def _new_job(self, job_id: int, **kwargs) -> PipelineJob:
         job = PipelineJob(
             id=job_id,
-            status="Running",
-            message="Starting pipeline..."
+            resources=self.resources,
+            stage_executor=self.scheduler.stage_executor,
+            on_change=self._job_changed,
+            checkpoints=StageCheckpoints(os.path.join(self.checkpoint_dir, str(job_id))),
+            on_checkpoint=self._job_checkpointed,
+            on_finish=self._job_finished,
+            submit=self.scheduler.submit,
+            **kwargs
+        )
+        with self._lock:
+            self.jobs[job_id] = job
+        return job
+
+    def _save_job(self, job: PipelineJob, **values):
+        try:
+            self.store.save(job.id, status=job.status, message=job.message, start_time=job.start_time,
+                            end_time=job.end_time, duration_seconds=job.duration, **values)
+        except Exception as e:
+            logger.error(f"Error saving pipeline job {job.id}: {str(e)}")
+
+    def _job_changed(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            self._save_job(job)
+        self.changes.publish(job_id)
+
+    def _job_checkpointed(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            self._save_job(job, checkpoints=list(job.completed_stages))
+
+    def _job_finished(self, job: PipelineJob):
+        """Write the final record of a job and drop it, with its stage outputs, from memory"""
+        self._save_job(job, metrics=job.metrics.to_dict(), checkpoints=[])
+        with self._lock:
+            self.jobs.pop(job.id, None)
+        self.changes.publish(job.id)
+
+    def recover_jobs(self, include_own: bool = False):
+        """Resume active jobs whose process stopped sending heartbeats
+
+        ``include_own`` also takes back jobs recorded under this process's
+        name, which at startup were left by an earlier run of the same
+        container.
+        """
+        try:
+            rows = self.store.claim_stale(ACTIVE_STATUSES, self.stale_after, include_own=include_own)
+        except Exception as e:
+            logger.error(f"Error recovering pipeline jobs: {str(e)}")
+            return
+        for row in rows:
+            cancelled = row['status'] == 'Cancelling' or row['requested_action'] == 'cancel'
+            job = self._new_job(
+                row['id'],
+                status=row['status'] if cancelled else "Queued",
+                message="Resuming after a restart, waiting for a free pipeline worker...",
+                start_time=row['start_time'],
+                survey_year=row['survey_year'],
+                bucket_name=row['bucket'],
+                source_prefix=row['prefix'],
+                completed_stages=row['checkpoints'] or [],
+            )
+            if cancelled:
+                # The cancelled run stopped with its process, only the record is left to finish
+                job.cancel()
+                job.checkpoints.clear()
+                self._job_finished(job)
+                continue
+            if row['status'] == 'Paused':
+                job.pause()
+                job.status = "Paused"
+                job.message = "Pipeline paused"
+            job.queue()
+            logger.info(f"Recovered pipeline {job.id} after stages {job.completed_stages}")
+
+    def _heartbeat_loop(self):
+        last_check = datetime.utcnow()
+        while not self._stopping.wait(self.heartbeat_interval):
+            try:
+                with self._lock:
+                    job_ids = list(self.jobs)
+                # Apply actions requested through other processes
+                for job_id, action in self.store.heartbeat(job_ids).items():
+                    job = self.jobs.get(job_id)
+                    if job is not None:
+                        apply_action(job, action)
+                # Stream changes of jobs run by other processes
+                now = datetime.utcnow()
+                for job_id in self.store.changed_since(last_check):
+                    self.changes.publish(job_id)
+                last_check = now
+                self.recover_jobs()
+            except Exception as e:
+                logger.error(f"Pipeline job heartbeat failed: {str(e)}")
+
+    def conflicting_job(self, bucket_name: str, source_prefix: str) -> Optional[dict]:
+        """Active job, in any process, whose objects or result rows overlap the given prefix"""
+        for job in self.store.active(ACTIVE_STATUSES):
+            if prefixes_overlap(job['bucket'], job['prefix'], bucket_name, source_prefix):
+                return job
+        return None
+
+    def create_job(self, survey_year: str = DEFAULT_SURVEY_YEAR, bucket_name: Optional[str] = None,
+                   source_prefix: str = ''):
+        """Queue a pipeline job for one survey year, bucket and object prefix"""
+        status, message = "Queued", "Waiting for a free pipeline worker..."
+        job_id = self.store.create(status, message, survey_year,
+                                   bucket_name or DataExtractor.SOURCE_BUCKET, source_prefix)
+        job = self._new_job(
+            job_id,
+            status=status,
+            message=message,
+            survey_year=survey_year,
+            bucket_name=bucket_name,
+            source_prefix=source_prefix,
         )
-        job.start()
-        self.jobs[job_id] = job
+        self.changes.publish(job_id)
+        job.queue()
         return job
 
     def get_job(self, job_id):
+        """Job running in this process, if any"""
         return self.jobs.get(job_id)
 
+    def job_record(self, job_id, metrics: bool = False) -> Optional[dict]:
+        """Summary of a job wherever it runs, with its metrics if asked for"""
+        job = self.get_job(job_id)
+        if job is not None:
+            return job.to_dict() if metrics else job.summary()
+        record = self.store.get(job_id)
+        if record is not None and not metrics:
+            record = {key: record[key] for key in RECORD_FIELDS}
+        return record
+
+    def page_of_jobs(self, page: int, per_page: int):
+        """Summaries of one page of the job history, newest first, and the total number of jobs"""
+        records, total = self.store.page(page, per_page)
+        # Jobs running here are more current than their last save
+        return [self.job_record(record['id']) if record['id'] in self.jobs else record
+                for record in records], total
+
+    def request_action(self, job_id, action: str) -> Optional[dict]:
+        """Pause, resume or cancel a job, forwarding it to the process that runs it"""
+        job = self.get_job(job_id)
+        if job is not None:
+            apply_action(job, action)
+            return job.summary()
+        if not self.store.request_action(job_id, action, ACTIVE_STATUSES):
+            return None
+        return self.job_record(job_id)
+
     def update_job_status(self, job_id, status, message):
         job = self.get_job(job_id)
         if job:
@@ -168,68 +547,181 @@ class PipelineManager:
             return True
         return False
 
-pipeline_manager = PipelineManager()
+def apply_action(job: PipelineJob, action: str):
+    """Pause, resume or cancel a job run by this process"""
+    if job.stop_event.is_set():
+        # A job being cancelled keeps reporting Cancelling until it has drained
+        return
+    if action == 'pause':
+        job.pause()
+        job.status = "Paused"
+        job.message = "Pipeline paused"
+    elif action == 'resume':
+        job.resume()
+    elif action == 'cancel':
+        # Returns at once, the job reports Cancelling until it has drained
+        job.cancel()
+
+_pipeline_manager: Optional[PipelineManager] = None
+_pipeline_manager_lock = Lock()
+
+def pipeline_manager() -> PipelineManager:
+    """The process's pipeline manager, created on first use
+
+    Spawned transform workers re-import this module as ``__mp_main__``; creating
+    the manager lazily keeps them from recovering jobs, sending heartbeats
+    or starting a scheduler of their own.
+    """
+    global _pipeline_manager
+    with _pipeline_manager_lock:
+        if _pipeline_manager is None:
+            _pipeline_manager = PipelineManager()
+        return _pipeline_manager
+
+# Seconds an event stream or long poll waits for changes before answering
+POLL_TIMEOUT = 15
+JOBS_PER_PAGE = 20
+# S3 bucket naming rules; the name also becomes a cache directory, so no path separators
+BUCKET_NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9.-]{1,61}[a-z0-9]$')
+
+def wants_json() -> bool:
+    """True for API clients, False for browser form posts"""
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json'
+
+def page_args():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', JOBS_PER_PAGE, type=int), 1), 100)
+    return page, per_page
+
+def action_response(job: Optional[dict], message: str, error: str):
+    """JSON summary for API clients, a flash message and redirect for form posts"""
+    if wants_json():
+        if job is None:
+            return jsonify({'error': error}), 404
+        return jsonify({'message': message, 'job': job})
+    flash(message if job else error)
+    return redirect('/')
 
 @bp.route('/')
 def index():
-    return render_template(
-        'index.html',
-        jobs=reversed(pipeline_manager.jobs.values())
-    )
+    return render_template('index.html', per_page=JOBS_PER_PAGE)
+
+@bp.route('/jobs')
+@bp.route('/status')
+def jobs_status():
+    page, per_page = page_args()
+    manager = pipeline_manager()
+    # Read the version first so no change is missed between listing and streaming
+    version = manager.changes.version
+    jobs, total = manager.page_of_jobs(page, per_page)
+    return jsonify({
+        'jobs': jobs,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'version': version,
+    })
+
+@bp.route('/jobs/<int:job_id>')
+@bp.route('/<int:job_id>/status')
+def job_status(job_id):
+    job = pipeline_manager().job_record(job_id, metrics=True)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+def changed_jobs(job_ids: list) -> list:
+    return [job for job in map(pipeline_manager().job_record, job_ids) if job is not None]
+
+@bp.route('/jobs/changes')
+def job_changes():
+    """Long poll: wait for jobs changed after version ``since``"""
+    changes = pipeline_manager().changes
+    since = request.args.get('since', changes.version, type=int)
+    timeout = min(request.args.get('timeout', POLL_TIMEOUT, type=float), 60)
+    version, job_ids = changes.wait(since, timeout)
+    if job_ids is None:
+        return jsonify({'version': version, 'reset': True})
+    return jsonify({'version': version, 'jobs': changed_jobs(job_ids)})
+
+@bp.route('/jobs/events')
+def job_events():
+    """Server-Sent Events stream of job changes after version ``since``"""
+    changes = pipeline_manager().changes
+    since = request.args.get('since', type=int)
+    if since is None:
+        since = int(request.headers.get('Last-Event-ID') or changes.version)
+
+    def stream(since: int):
+        while True:
+            version, job_ids = changes.wait(since, POLL_TIMEOUT)
+            if job_ids is None:
+                yield f"id: {version}\nevent: reset\ndata: {{}}\n\n"
+            elif job_ids:
+                for job in changed_jobs(job_ids):
+                    yield f"id: {version}\nevent: job\ndata: {json.dumps(job)}\n\n"
+            else:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            since = version
+
+    return Response(stream(since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/metrics')
+def metrics():
+    manager = pipeline_manager()
+    return Response(render_prometheus(list(manager.jobs.values()), manager.store.status_counts()),
+                    mimetype='text/plain; version=0.0.4')
 
 @bp.route('/new', methods=['POST'])
 def new_job():
-    if any(job.status in ('Running', 'Paused') for job in pipeline_manager.jobs.values()):
-        flash('Cannot start a new pipeline while another is running or paused')
+    survey_year = request.form.get('survey_year', '').strip() or DEFAULT_SURVEY_YEAR
+    bucket_name = request.form.get('bucket', '').strip() or None
+    source_prefix = request.form.get('prefix', '').strip()
+
+    if bucket_name and (not BUCKET_NAME_PATTERN.match(bucket_name) or '..' in bucket_name):
+        message = f'Invalid bucket name {bucket_name!r}'
+        if wants_json():
+            return jsonify({'error': message}), 400
+        flash(message)
         return redirect('/')
 
-    job = pipeline_manager.create_job()
-    flash(f'Started new pipeline job #{job.id}')
+    # Jobs on overlapping data would overwrite each other's results
+    conflict = pipeline_manager().conflicting_job(bucket_name or DataExtractor.SOURCE_BUCKET, source_prefix)
+    if conflict:
+        message = f'Cannot start a new pipeline while job #{conflict["id"]} is processing the same data'
+        if wants_json():
+            return jsonify({'error': message}), 409
+        flash(message)
+        return redirect('/')
+
+    job = pipeline_manager().create_job(survey_year, bucket_name, source_prefix)
+    if wants_json():
+        return jsonify({'message': f'Queued new pipeline job #{job.id}', 'job': job.summary()}), 201
+    flash(f'Queued new pipeline job #{job.id} for {job.survey_year}')
     return redirect('/')
 
 @bp.route('/<int:job_id>/pause', methods=['POST'])
 def pause_job(job_id):
-    job = pipeline_manager.get_job(job_id)
-    job.pause()
-    if pipeline_manager.update_job_status(
-        job_id, 
-        "Paused", 
-        "Pipeline paused"
-    ):
-        flash('Job paused successfully')
-    else:
-        flash('Error pausing job')
-    return redirect('/')
+    job = pipeline_manager().request_action(job_id, 'pause')
+    return action_response(job, 'Job paused successfully', 'Error pausing job')
 
 @bp.route('/<int:job_id>/resume', methods=['POST'])
 def resume_job(job_id):
-    job = pipeline_manager.get_job(job_id)
-    job.resume()
-    if pipeline_manager.update_job_status(
-        job_id, 
-        "Running", 
-        "Pipeline resumed"
-    ):
-        flash('Job resumed successfully')
-    else:
-        flash('Error resuming job')
-    return redirect('/')
+    job = pipeline_manager().request_action(job_id, 'resume')
+    return action_response(job, 'Job resumed successfully', 'Error resuming job')
 
 @bp.route('/<int:job_id>/cancel', methods=['POST'])
 def cancel_job(job_id):
-    job = pipeline_manager.get_job(job_id)
-    job.cancel()
-    if pipeline_manager.update_job_status(
-        job_id, 
-        "Cancelled", 
-        "Pipeline cancelled"
-    ):
-        flash('Job cancelled successfully')
-    else:
-        flash('Error cancelling job')
-    return redirect('/')
+    # Returns at once, the job reports Cancelling until it has drained
+    job = pipeline_manager().request_action(job_id, 'cancel')
+    return action_response(job, 'Job cancellation requested', 'Error cancelling job')
 
 app.register_blueprint(bp)
 
 if __name__ == '__main__':
+    # Recover unfinished jobs at startup rather than on the first request
+    pipeline_manager()
     app.run(host='0.0.0.0', port=8081)
@@ -0,0 +1,410 @@
+"""Benchmark the pipeline stages on synthetic survey data
+
+Generate survey CSVs at a given scale, run extract, transform and both loads
+against a local filesystem object store and a local database, and write
+per-stage timings as JSON that can be compared between versions:
+
+    python benchmark.py generate data --rows 1000000 --files 10 --districts 100
+    python benchmark.py run data --database-url sqlite:///bench.db --output before.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py edge-cases
+    python benchmark.py parity data
+
+Pipeline settings such as TRANSFORM_WORKERS or OUTPUT_FORMAT are read from
+the environment as usual and recorded with the results. ``parity`` checks
+that the DuckDB transform engine gives the same metrics as the pandas one.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from extract import DataExtractor
+from instrumentation import peak_rss_bytes
+from resources import ResourceRegistry
+from storage import LocalStore
+
+logger = logging.getLogger(__name__)
+
+QUARTILES = ['Q1', 'Q2', 'Q3', 'Q4']
+SEXES = ['Male', 'Female']
+EDUCATION_LEVELS = ['None', 'Primary', 'Secondary', 'Tertiary']
+# Environment settings that change what a run measures
+SETTINGS = ['EXTRACT_WORKERS', 'INCREMENTAL_EXTRACT', 'PARQUET_CACHE', 'MEDIAN_MODE', 'DISTINCT_MODE',
+            'STREAMING_TRANSFORM', 'TRANSFORM_WORKERS', 'TRANSFORM_SHARD_BY', 'TRANSFORM_ENGINE',
+            'DUCKDB_THREADS', 'COPY_CHUNKSIZE',
+            'LOAD_MODE', 'OUTPUT_FORMAT']
+
+def synthetic_survey(rows: int, rng: np.random.Generator, districts: int, households: int,
+                     missing: float = 0.05) -> pd.DataFrame:
+    """Survey rows with the raw column set, ``missing`` of the age and sex values left empty"""
+    start = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 86400 * 90, rows), unit='s')
+    df = pd.DataFrame({
+        'hhid_2': np.char.add('H', rng.integers(0, households, rows).astype(str)),
+        'district': rng.integers(1, districts + 1, rows),
+        'Quartile': rng.choice(QUARTILES, rows),
+        'hh_size': rng.integers(1, 15, rows),
+        'hhh_age': rng.integers(18, 90, rows).astype(float),
+        'hhh_sex': rng.choice(SEXES, rows).astype(object),
+        'SubmissionDate': (start + pd.Timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'),
+        'starttime': start.strftime('%Y-%m-%d %H:%M:%S'),
+        'endtime': (start + pd.to_timedelta(rng.integers(300, 7200, rows), unit='s')).strftime('%Y-%m-%d %H:%M:%S'),
+        'GPS-Accuracy': rng.gamma(2.0, 5.0, rows).round(1),
+        'hhh_educ_level': rng.choice(EDUCATION_LEVELS, rows),
+        'hhh_read_write': rng.integers(0, 2, rows),
+        'age_6_12_Attend_Sch_1': rng.integers(0, 4, rows),
+        'age_13_18_Attend_Sch_1': rng.integers(0, 4, rows),
+        'Number_Radios': rng.integers(0, 3, rows),
+        'Number_Mobile_Phones': rng.integers(0, 5, rows),
+        'assets_reported_total': rng.integers(0, 40, rows),
+    })
+    df.loc[rng.random(rows) < missing, 'hhh_age'] = np.nan
+    df.loc[rng.random(rows) < missing, 'hhh_sex'] = None
+    return df
+
+def generate_survey_files(directory: str, rows: int, files: int, districts: int = 100,
+                          households: Optional[int] = None, seed: int = 0,
+                          chunk_rows: int = 1_000_000) -> List[str]:
+    """Write ``rows`` synthetic survey rows spread over ``files`` CSV files
+
+    Files are written a chunk at a time, so any scale fits in memory. The
+    same arguments always produce the same files.
+    """
+    households = households or max(rows // 5, 1)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index in range(files):
+        file_rows = rows // files + (1 if index < rows % files else 0)
+        path = os.path.join(directory, f"survey_{index:04d}.csv")
+        with open(path, 'w', newline='') as output:
+            for chunk, start in enumerate(range(0, max(file_rows, 1), chunk_rows)):
+                rng = np.random.default_rng([seed, index, chunk])
+                df = synthetic_survey(min(chunk_rows, file_rows - start), rng, districts, households)
+                df.to_csv(output, index=False, header=chunk == 0)
+        paths.append(path)
+        logger.info(f"Generated {path} ({file_rows} rows)")
+    return paths
+
+# Rows per streaming chunk in the edge-case check, so small surveys span several chunks
+EDGE_CASE_CHUNK_SIZE = 5
+
+def edge_case_surveys(seed: int = 0) -> Dict[str, pd.DataFrame]:
+    """Small survey frames with the raw column set that exercise transform edge cases"""
+    rng = np.random.default_rng(seed)
+    cases = {'empty': synthetic_survey(0, rng, districts=2, households=1)}
+
+    missing_keys = synthetic_survey(40, rng, districts=2, households=10)
+    # Rows with a blank key belong to no group and are left out
+    missing_keys.loc[::7, 'district'] = np.nan
+    missing_keys.loc[3::5, 'Quartile'] = None
+    cases['missing_keys'] = missing_keys
+
+    no_complete_keys = synthetic_survey(10, rng, districts=2, households=5)
+    # Every row misses one key, so there are no groups at all
+    no_complete_keys.loc[::2, 'district'] = np.nan
+    no_complete_keys.loc[1::2, 'Quartile'] = None
+    cases['no_complete_keys'] = no_complete_keys
+
+    blank_chunk = synthetic_survey(30, rng, districts=2, households=10)
+    blank_chunk['district'] = [1, 2] * 15
+    # A whole streaming chunk of rows without a district
+    blank_chunk.loc[EDGE_CASE_CHUNK_SIZE:2 * EDGE_CASE_CHUNK_SIZE - 1, 'district'] = np.nan
+    # A shard whose rows all miss another key
+    blank_chunk.loc[blank_chunk['district'] == 2, 'Quartile'] = None
+    cases['blank_chunk'] = blank_chunk
+
+    ties = synthetic_survey(8, rng, districts=1, households=4)
+    ties['Quartile'] = 'Q1'
+    # Two values of each mode column are equally common, the smallest one wins
+    ties['hhh_sex'] = SEXES * 4
+    ties['hhh_educ_level'] = EDUCATION_LEVELS[2:] * 4
+    cases['ties'] = ties
+
+    all_null = synthetic_survey(12, rng, districts=2, households=6)
+    # Groups where every value of a column is missing
+    for col in ('hhh_age', 'hhh_sex', 'hhh_educ_level', 'Number_Radios'):
+        all_null.loc[all_null['district'] == 1, col] = None
+    cases['all_null'] = all_null
+    return cases
+
+def check_edge_cases(rollups: Optional[Dict[str, List[str]]] = None) -> List[str]:
+    """Transform every frame of ``edge_case_surveys`` in each execution mode
+
+    Each case is read through a local object store like real survey files and
+    transformed in memory, in worker processes, by streaming and by the
+    DuckDB engine; the modes must agree and leave out rows with a missing
+    key, and the DuckDB frames must also have the same dtypes. ``rollups`` default to
+    the pipeline's levels plus a grand total. Raises AssertionError on the
+    first failure; returns the names of the cases checked.
+    """
+    store_root = tempfile.mkdtemp(prefix='rtv-edge-cases-')
+    resources = ResourceRegistry()
+    try:
+        job = DataExtractor(resources)
+        job.object_store = LocalStore(store_root)
+        job.chunk_size = EDGE_CASE_CHUNK_SIZE
+        rollups = rollups or {**job.rollups, 'total_metrics': []}
+        for name, frame in edge_case_surveys().items():
+            job.bucket_name = name
+            job.cache_dir = os.path.join(store_root, 'cache', name)
+            os.makedirs(os.path.join(store_root, name))
+            frame.to_csv(os.path.join(store_root, name, 'survey.csv'), index=False)
+
+            df = job.extract_survey_data()
+            results = {}
+            for workers in (1, 2):
+                job.transform_workers = workers
+                results[f"workers={workers}"] = job.transform_survey_data(df, rollups=rollups)
+            job.transform_workers = 1
+            # Plain object keys take a different groupby path than categoricals
+            results['object keys'] = job.transform_survey_data(
+                df.astype({key: object for key in job.grouping_cols}), rollups=rollups)
+            results['streaming'] = job.transform_partials(job.extract_survey_partials(), rollups=rollups)
+            job.transform_engine = 'duckdb'
+            results['duckdb'] = job.transform_survey_data(df, rollups=rollups)
+            job.transform_engine = 'pandas'
+
+            expected = results.pop('workers=1')
+            groups = len(df.dropna(subset=job.grouping_cols).groupby(job.grouping_cols, observed=True))
+            assert len(expected['detailed_metrics']) == groups, \
+                f"{name}: {len(expected['detailed_metrics'])} detailed rows, expected {groups}"
+            for mode, result in results.items():
+                for level, frame in expected.items():
+                    try:
+                        # The DuckDB engine must also match dtypes and categories, except
+                        # for a survey without rows, whose columns have no dtype to keep
+                        exact = mode == 'duckdb' and len(df) > 0
+                        pd.testing.assert_frame_equal(result[level], frame, check_dtype=exact,
+                                                      check_categorical=exact, rtol=1e-9)
+                    except AssertionError as e:
+                        raise AssertionError(f"{name}: {level} differs with {mode}: {str(e)}") from e
+        return list(edge_case_surveys())
+    finally:
+        resources.dispose()
+        shutil.rmtree(store_root, ignore_errors=True)
+
+def survey_summary_ddl() -> List[str]:
+    """CREATE statements of metrics.survey_summary and its indexes, taken from init-db.sql"""
+    init_sql = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'init-db.sql')
+    with open(init_sql) as sql_file:
+        statements = [statement.strip() for statement in
+                      re.sub(r'--[^\n]*', '', sql_file.read()).split(';')]
+    return [statement for statement in statements
+            if re.match(r'CREATE (TABLE|INDEX) IF NOT EXISTS \S+ ON metrics\.survey_summary\b', statement)
+            or statement.startswith('CREATE TABLE IF NOT EXISTS metrics.survey_summary ')]
+
+def benchmark_engine(database_url: str) -> sqlalchemy.engine.Engine:
+    """Engine with a metrics.survey_summary table to load into
+
+    SQLite has no schemas, so a database named ``metrics`` is attached to
+    every connection, kept in a file beside the main one.
+    """
+    engine = sqlalchemy.create_engine(database_url)
+    if engine.dialect.name == 'sqlite':
+        database = engine.url.database
+        metrics_path = f"{database}.metrics" if database and database != ':memory:' else ':memory:'
+
+        @sqlalchemy.event.listens_for(engine, 'connect')
+        def attach_metrics(dbapi_connection, connection_record):
+            dbapi_connection.execute(f"ATTACH DATABASE '{metrics_path}' AS metrics")
+
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            connection.execute(sqlalchemy.text("CREATE SCHEMA IF NOT EXISTS metrics"))
+        for statement in survey_summary_ddl():
+            if engine.dialect.name == 'sqlite':
+                # SQLite names the schema on the index rather than the table
+                statement = re.sub(r'INDEX IF NOT EXISTS (\S+) ON metrics\.', r'INDEX IF NOT EXISTS metrics.\1 ON ',
+                                   statement)
+            connection.execute(sqlalchemy.text(statement))
+    return engine
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def stage_results(metrics: dict) -> Dict[str, dict]:
+    """Wall time, counters and throughput of each stage from a job's metrics"""
+    results = {}
+    for name, stage in metrics['stages'].items():
+        wall = stage['wall_seconds']
+        rows = stage['rows_in'] or stage['rows_out']
+        result = {key: stage[key] for key in ('wall_seconds', 'rows_in', 'rows_out', 'bytes_read',
+                                              'bytes_written', 'db_rows', 'peak_rss_bytes')}
+        result['rows_per_second'] = round(rows / wall, 1) if wall else None
+        result['mb_per_second'] = round((stage['bytes_read'] + stage['bytes_written']) / wall / 2 ** 20, 2) \
+            if wall else None
+        results[name] = result
+    return results
+
+def local_job(resources: ResourceRegistry, store_root: str, data_dir: str, bucket_name: str,
+              cache_dir: str) -> DataExtractor:
+    """Job reading ``data_dir`` as bucket ``bucket_name`` of a local object store at ``store_root``"""
+    os.symlink(os.path.abspath(data_dir), os.path.join(store_root, bucket_name))
+    job = DataExtractor(resources)
+    job.object_store = LocalStore(store_root)
+    job.bucket_name = bucket_name
+    job.cache_dir = cache_dir
+    return job
+
+def run_benchmark(data_dir: str, database_url: str, bucket_name: str = DataExtractor.SOURCE_BUCKET,
+                  cache_dir: Optional[str] = None) -> dict:
+    """Run every pipeline stage once over the CSV files in ``data_dir``
+
+    ``data_dir`` serves as bucket ``bucket_name`` of a local object store,
+    results are written to a scratch bucket removed afterwards. Without
+    ``cache_dir`` a fresh cache directory is used, so extraction is
+    measured cold.
+    """
+    store_root = tempfile.mkdtemp(prefix='rtv-benchmark-')
+    cache_dir = cache_dir or os.path.join(store_root, 'cache')
+    resources = ResourceRegistry()
+    try:
+        job = local_job(resources, store_root, data_dir, bucket_name, cache_dir)
+        job.engine = benchmark_engine(database_url)
+
+        started = time.perf_counter()
+        df = job.extract_survey_data()
+        input_rows = len(df)
+        results = job.transform_survey_data(df)
+        del df
+        for name, result in results.items():
+            job.load_to_minio(result, survey_year='benchmark', object_name=job.results_object_name(name))
+        job.load_to_database(results['detailed_metrics'], survey_year='benchmark')
+        total_seconds = time.perf_counter() - started
+        job.engine.dispose()
+
+        return {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'database': job.engine.dialect.name,
+                'input_rows': input_rows,
+                'input_files': len(job.metrics.stages['extract'].objects),
+                'settings': {name: os.environ[name] for name in SETTINGS if name in os.environ},
+            },
+            'total_seconds': round(total_seconds, 3),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': stage_results(job.metrics.to_dict()),
+        }
+    finally:
+        resources.dispose()
+        # Removes the link to the input directory, not the files it points to
+        shutil.rmtree(store_root, ignore_errors=True)
+
+def check_parity(data_dir: str, bucket_name: str = DataExtractor.SOURCE_BUCKET) -> Dict[str, float]:
+    """Transform the CSV files in ``data_dir`` with both engines and compare the metrics
+
+    Medians and distinct counts are exact, so the frames must match up to
+    floating point summation order. Raises AssertionError on the first
+    difference; returns the transform seconds of each engine.
+    """
+    store_root = tempfile.mkdtemp(prefix='rtv-parity-')
+    resources = ResourceRegistry()
+    try:
+        job = local_job(resources, store_root, data_dir, bucket_name, os.path.join(store_root, 'cache'))
+        df = job.extract_survey_data()
+        results = {}
+        seconds = {}
+        for engine in ('pandas', 'duckdb'):
+            job.transform_engine = engine
+            started = time.perf_counter()
+            results[engine] = job.transform_survey_data(df, median='exact', distinct='exact')
+            seconds[engine] = round(time.perf_counter() - started, 3)
+        assert results['pandas'].keys() == results['duckdb'].keys(), 'engines return different levels'
+        for name, expected in results['pandas'].items():
+            try:
+                pd.testing.assert_frame_equal(results['duckdb'][name], expected, rtol=1e-9)
+            except AssertionError as e:
+                raise AssertionError(f"{name} differs between engines: {str(e)}") from e
+        return seconds
+    finally:
+        resources.dispose()
+        shutil.rmtree(store_root, ignore_errors=True)
+
+def compare_results(baseline: dict, candidate: dict) -> str:
+    """Table of the wall time of each stage in two runs and the relative change"""
+    lines = [f"{'stage':<16}{'baseline s':>12}{'candidate s':>13}{'change':>9}"]
+    rows = [(name, baseline['stages'].get(name, {}).get('wall_seconds'),
+             candidate['stages'].get(name, {}).get('wall_seconds'))
+            for name in dict.fromkeys(list(baseline['stages']) + list(candidate['stages']))]
+    rows.append(('total', baseline.get('total_seconds'), candidate.get('total_seconds')))
+    for name, before, after in rows:
+        change = f"{(after - before) / before:+.1%}" if before and after is not None else ''
+        lines.append(f"{name:<16}{before if before is not None else '-':>12}"
+                     f"{after if after is not None else '-':>13}{change:>9}")
+    return '\n'.join(lines)
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='write synthetic survey CSV files')
+    generate.add_argument('directory')
+    generate.add_argument('--rows', type=int, default=100_000)
+    generate.add_argument('--files', type=int, default=10)
+    generate.add_argument('--districts', type=int, default=100)
+    generate.add_argument('--households', type=int, help='distinct household ids (default rows / 5)')
+    generate.add_argument('--seed', type=int, default=0)
+
+    run = commands.add_parser('run', help='run the pipeline stages over generated files')
+    run.add_argument('directory')
+    run.add_argument('--database-url', default='sqlite:///benchmark.db',
+                     help='SQLAlchemy URL of a local PostgreSQL or SQLite database')
+    run.add_argument('--cache-dir', help='reuse a cache directory instead of a fresh one')
+    run.add_argument('--output', help='write the results here instead of to stdout')
+
+    compare = commands.add_parser('compare', help='compare two result files')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+
+    commands.add_parser('edge-cases', help='transform small edge-case surveys in every execution mode and engine')
+
+    parity = commands.add_parser('parity', help='check the DuckDB transform engine against pandas')
+    parity.add_argument('directory')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+    if args.command == 'generate':
+        generate_survey_files(args.directory, args.rows, args.files, args.districts,
+                              args.households, args.seed)
+    elif args.command == 'run':
+        results = json.dumps(run_benchmark(args.directory, args.database_url, cache_dir=args.cache_dir),
+                             indent=2)
+        if args.output:
+            with open(args.output, 'w') as output:
+                output.write(results + '\n')
+        else:
+            print(results)
+    elif args.command == 'edge-cases':
+        print('Edge cases pass: ' + ', '.join(check_edge_cases()))
+    elif args.command == 'parity':
+        print('Edge cases pass: ' + ', '.join(check_edge_cases()))
+        seconds = check_parity(args.directory)
+        print('Engines agree: ' + ', '.join(f"{engine} {wall}s" for engine, wall in seconds.items()))
+    else:
+        with open(args.baseline) as baseline, open(args.candidate) as candidate:
+            print(compare_results(json.load(baseline), json.load(candidate)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
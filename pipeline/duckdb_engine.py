@@ -0,0 +1,146 @@
+import logging
+from typing import Dict, List, Optional
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+
+from aggregates import MODE, MODE_LABEL, SKETCH_MODES, SUPPORTED_AGGREGATIONS
+
+logger = logging.getLogger(__name__)
+
+# Name the survey rows are registered under in each DuckDB connection
+SURVEY_VIEW = 'survey'
+
+def quote(name: str) -> str:
+    """Quote a column name as a DuckDB identifier"""
+    return '"' + name.replace('"', '""') + '"'
+
+def arrow_survey_table(columns: Dict[str, pd.Series]) -> pa.Table:
+    """Arrow table of the survey columns a query reads
+
+    Categorical columns are passed as their integer codes, with missing values
+    as nulls, so they group and order by category position as pandas does.
+    Numeric columns are not copied.
+    """
+    arrays = {}
+    for col, series in columns.items():
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes = series.cat.codes.to_numpy()
+            arrays[col] = pa.array(codes, mask=codes < 0)
+        else:
+            arrays[col] = pa.Array.from_pandas(series)
+    return pa.table(arrays)
+
+def metric_expression(ref: str, agg: str, median: str, median_precision: int, distinct: str,
+                      integer: bool) -> str:
+    """DuckDB aggregate of the column ``ref`` for one entry of a metric spec, modes excepted"""
+    value = f"CAST({ref} AS DOUBLE)"
+    if agg == 'count':
+        return f"COUNT({ref})"
+    if agg == 'sum':
+        # An all-null group sums to 0, as in pandas
+        total = f"COALESCE(SUM({ref}), 0)"
+        return f"CAST({total} AS {'BIGINT' if integer else 'DOUBLE'})"
+    if agg in ('min', 'max'):
+        return f"{agg.upper()}({ref})"
+    if agg == 'mean':
+        return f"AVG({value})"
+    if agg == 'median':
+        if median == 'approx':
+            value = f"ROUND({value}, {int(median_precision)})"
+        return f"MEDIAN({value})"
+    if distinct == 'approx':
+        return f"CAST(APPROX_COUNT_DISTINCT({ref}) AS BIGINT)"
+    return f"COUNT(DISTINCT {ref})"
+
+def metrics_query(keys: List[str], spec: Dict[str, List[str]], integer_columns: List[str],
+                  median: str = 'exact', median_precision: int = 1, distinct: str = 'exact',
+                  required: Optional[List[str]] = None) -> str:
+    """One query computing every metric of ``spec`` per group of ``keys``, in key order
+
+    Modes are taken from per-group value counts in a CTE per column; ties go to
+    the smallest value, as in ``PartialAggregates``. Rows with a missing value
+    in ``keys`` or ``required`` belong to no group, as in a pandas groupby.
+    """
+    not_null = list(dict.fromkeys(keys + (required or [])))
+    keys_not_null = lambda table: ' AND '.join(
+        [f"{table}.{quote(key)} IS NOT NULL" for key in not_null] or ['TRUE'])
+    selects = [f"m.{quote(key)} AS {quote(key + '_')}" for key in keys]
+    ctes = []
+    joins = []
+    for col, aggs in spec.items():
+        for agg in aggs:
+            alias = quote(f"{col}_{MODE_LABEL if agg == MODE else agg}")
+            if agg != MODE:
+                expression = metric_expression(f"m.{quote(col)}", agg, median, median_precision,
+                                               distinct, col in integer_columns)
+                selects.append(f"{expression} AS {alias}")
+                continue
+            name = f"mode_{len(ctes)}"
+            group_keys = ''.join(f"{quote(key)}, " for key in keys)
+            counts = (f"SELECT {group_keys}{quote(col)} AS value, COUNT(*) AS n FROM {SURVEY_VIEW} AS s "
+                      f"WHERE {keys_not_null('s')} AND {quote(col)} IS NOT NULL "
+                      f"GROUP BY {group_keys}{quote(col)}")
+            ctes.append(f"{name} AS (SELECT {group_keys}FIRST(value ORDER BY n DESC, value) AS value "
+                        f"FROM ({counts}) AS c{' GROUP BY ' + group_keys.rstrip(', ') if keys else ''})")
+            on = ' AND '.join([f"m.{quote(key)} = {name}.{quote(key)}" for key in keys] or ['TRUE'])
+            joins.append(f"LEFT JOIN {name} ON {on}")
+            selects.append(f"ANY_VALUE({name}.value) AS {alias}")
+
+    query = (f"SELECT {', '.join(selects)} FROM {SURVEY_VIEW} AS m {' '.join(joins)} "
+             f"WHERE {keys_not_null('m')}")
+    if keys:
+        query += (f" GROUP BY {', '.join(f'm.{quote(key)}' for key in keys)}"
+                  f" ORDER BY {', '.join(quote(key + '_') for key in keys)}")
+    else:
+        # A single group, unless there are no rows at all
+        query += " HAVING COUNT(*) > 0"
+    return (f"WITH {', '.join(ctes)} " if ctes else '') + query
+
+def survey_metrics(columns: Dict[str, pd.Series], levels: Dict[str, List[str]],
+                   spec: Dict[str, List[str]], threads: int = 0, median: str = 'exact',
+                   median_precision: int = 1, distinct: str = 'exact') -> Dict[str, pd.DataFrame]:
+    """Metrics of ``spec`` at each grouping level of ``levels``, computed by DuckDB
+
+    ``columns`` holds the survey columns the spec and keys read. Each level is
+    one multi-threaded query over an Arrow view of them, run on ``threads``
+    threads (0 for one per core). Rows with a missing key of any level are
+    left out of every level, as pandas rollups are derived from the finest
+    one. Frames have the columns, dtypes and row order of
+    ``PartialAggregates.finalize``; ``median`` and ``distinct`` 'approx' use
+    DuckDB's rounding and HyperLogLog, so approximate values differ slightly
+    from the pandas engine's.
+    """
+    if median not in SKETCH_MODES:
+        raise ValueError(f"median must be one of {SKETCH_MODES}, got {median!r}")
+    if distinct not in SKETCH_MODES:
+        raise ValueError(f"distinct must be one of {SKETCH_MODES}, got {distinct!r}")
+    for col, aggs in spec.items():
+        unsupported = set(aggs) - SUPPORTED_AGGREGATIONS
+        if unsupported:
+            raise ValueError(f"Unsupported aggregations for {col}: {sorted(unsupported)}")
+
+    categories = {col: series.cat.categories for col, series in columns.items()
+                  if isinstance(series.dtype, pd.CategoricalDtype)}
+    integer_columns = [col for col, series in columns.items()
+                       if pd.api.types.is_integer_dtype(series.dtype) and col not in categories]
+    all_keys = list(dict.fromkeys(key for keys in levels.values() for key in keys))
+    connection = duckdb.connect(config={'threads': threads} if threads > 0 else {})
+    try:
+        connection.register(SURVEY_VIEW, arrow_survey_table(columns))
+        results = {}
+        for name, keys in levels.items():
+            result = connection.execute(metrics_query(keys, spec, integer_columns, median, median_precision,
+                                                      distinct, required=all_keys)).df()
+            # Categorical keys and modes come back as codes
+            coded = {**{f"{key}_": key for key in keys},
+                     **{f"{col}_{MODE_LABEL}": col for col, aggs in spec.items() if MODE in aggs}}
+            for output_col, col in coded.items():
+                if col in categories:
+                    codes = result[output_col].fillna(-1).astype('int64')
+                    result[output_col] = pd.Categorical.from_codes(codes, categories=categories[col])
+            results[name] = result
+        return results
+    finally:
+        connection.close()
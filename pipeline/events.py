@@ -0,0 +1,46 @@
+import threading
+from collections import deque
+from typing import List, Optional, Tuple
+
+class ChangeFeed:
+    """Versioned feed of changed job ids that readers can block on
+
+    Every ``publish`` bumps the version. A reader remembers the last version
+    it saw and asks for the jobs changed since then; only the most recent
+    ``history`` changes are kept, so a reader that fell further behind is
+    told to reload everything instead.
+    """
+
+    def __init__(self, history: int = 1000):
+        self.version = 0
+        self._changes = deque(maxlen=history)
+        self._condition = threading.Condition()
+
+    def publish(self, job_id):
+        """Record that a job changed and wake waiting readers"""
+        with self._condition:
+            self.version += 1
+            self._changes.append((self.version, job_id))
+            self._condition.notify_all()
+
+    def _changed_since(self, since: int) -> Optional[List]:
+        if since > self.version:
+            # The reader saw a feed from before a restart
+            return None
+        if since < self.version - len(self._changes):
+            return None
+        job_ids = []
+        for version, job_id in self._changes:
+            if version > since and job_id not in job_ids:
+                job_ids.append(job_id)
+        return job_ids
+
+    def wait(self, since: int, timeout: float) -> Tuple[int, Optional[List]]:
+        """Block until there are changes after ``since`` or ``timeout`` seconds pass
+
+        Returns the current version and the ids of jobs changed since then, or
+        None in place of the ids when the reader must reload every job.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != since, timeout=timeout)
+            return self.version, self._changed_since(since)
@@ -1,59 +1,355 @@
+import hashlib
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import logging
-from minio import Minio
-from io import StringIO
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+from pandas.api.types import is_integer_dtype
+from aggregates import PartialAggregates, PartialsAccumulator
+from manifest import ObjectManifest
+from resources import ResourceRegistry
 from transform import DataTransformer
 
 logger = logging.getLogger(__name__)
 
+# Low-cardinality survey columns stored as categoricals
+CATEGORICAL_COLUMNS = ['district', 'Quartile', 'hhh_sex', 'hhh_educ_level']
+# Timestamp columns parsed once when a file is read
+DATETIME_COLUMNS = ['SubmissionDate', 'starttime', 'endtime']
+
+def compact_survey_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert a parsed survey frame to compact, explicit dtypes in place"""
+    for col in DATETIME_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            try:
+                df[col] = pd.to_datetime(df[col])
+            except (ValueError, TypeError):
+                # Leave unparseable values for the transform step to report
+                pass
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS:
+            df[col] = df[col].astype('category')
+        elif is_integer_dtype(df[col].dtype):
+            # Counts and codes fit in much smaller integer types
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+def concat_survey_frames(dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate survey frames, keeping categoricals with a shared category set"""
+    for col in CATEGORICAL_COLUMNS:
+        if not all(col in df.columns and df[col].dtype == 'category' for df in dfs):
+            continue
+        categories = set()
+        for df in dfs:
+            categories.update(df[col].cat.categories)
+        try:
+            categories = sorted(categories)
+        except TypeError:
+            # Mixed category types cannot share an ordering, fall back to object
+            continue
+        for df in dfs:
+            df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(dfs, ignore_index=True)
+
 class DataExtractor(DataTransformer):
-    def __init__(self):
-        super().__init__()
-        
-        # Initialize MinIO client
-        self.minio_client = Minio(
-            "minio:9000",
+    # Bucket holding the raw survey files unless a job names another one
+    SOURCE_BUCKET = "rtv-survey"
+
+    def __init__(self, resources: Optional[ResourceRegistry] = None):
+        super().__init__(resources)
+
+        # Object store of the survey bucket, MinIO clients borrow from the shared pool
+        self.object_store = self.resources.object_store(
             access_key="rtv-test-user",
-            secret_key="rtv-test-password",
-            secure=False
+            secret_key="rtv-test-password"
         )
-        self.bucket_name = "rtv-survey"
+        self.bucket_name = self.SOURCE_BUCKET
+        # Only objects under this prefix are read, '' reads the whole bucket
+        self.source_prefix = ''
+        # Number of objects downloaded and parsed concurrently
+        self.extract_workers = int(os.getenv('EXTRACT_WORKERS', '8'))
+        # Only download new or changed objects, reusing cached frames for the rest
+        self.incremental_extract = os.getenv('INCREMENTAL_EXTRACT', '0') == '1'
+        # Keep a Parquet copy of every parsed object, keyed by its ETag
+        self.parquet_cache = os.getenv('PARQUET_CACHE', '1') == '1'
+        self.cache_dir = os.getenv('PIPELINE_CACHE_DIR', '.cache')
+
+    @property
+    def cache_scope_dir(self) -> str:
+        """Cache directory of the bucket, or of the prefix when one is set"""
+        directory = os.path.join(self.cache_dir, self.bucket_name)
+        if self.source_prefix:
+            # Jobs on different prefixes must not prune each other's entries
+            key = hashlib.sha1(self.source_prefix.encode('utf-8')).hexdigest()[:12]
+            directory = os.path.join(directory, 'prefixes', key)
+        return directory
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.cache_scope_dir, 'manifest.json')
+
+    @property
+    def parquet_cache_dir(self) -> str:
+        return os.path.join(self.cache_scope_dir, 'parquet')
+
+    @property
+    def partials_cache_dir(self) -> str:
+        return os.path.join(self.cache_scope_dir, 'partials')
+
+    def _parquet_cache_path(self, obj) -> str:
+        key = ObjectManifest.cache_key(obj.object_name, obj.etag)
+        return os.path.join(self.parquet_cache_dir, f"{key}.parquet")
+
+    def _write_cache(self, write, path: str):
+        """Atomically create a cache file by calling ``write`` with a temporary path"""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _partials_cache_path(self, obj, options: dict) -> str:
+        # Partials depend on the transform options as well as the object version
+        fingerprint = hashlib.sha1(repr(sorted(options.items())).encode('utf-8')).hexdigest()[:12]
+        key = ObjectManifest.cache_key(obj.object_name, obj.etag)
+        return os.path.join(self.partials_cache_dir, f"{key}-{fingerprint}.pkl")
+
+    def _evict_cache(self, directory: str, current_paths: list):
+        """Remove cached files that no longer match a listed object version"""
+        if not os.path.isdir(directory):
+            return
+        current = {os.path.basename(path) for path in current_paths}
+        for file_name in os.listdir(directory):
+            if not file_name.endswith('.tmp') and file_name not in current:
+                os.unlink(os.path.join(directory, file_name))
+
+    def read_survey_object(self, file_name: str) -> pd.DataFrame:
+        """Parse a single CSV object directly from the object store stream"""
+        self.wait_for_resume()
+        start = time.perf_counter()
+        reader = self.object_store.open(self.bucket_name, file_name)
+        try:
+            # pandas reads the raw bytes stream, no intermediate decode/StringIO copy;
+            # a stop closes the stream to interrupt the parse
+            with self.cancellable(reader.close):
+                df = pd.read_csv(reader)
+        finally:
+            reader.close()
+        self.metrics.record_object('extract', file_name, source=self.object_store.name, rows_in=len(df),
+                                   bytes_read=reader.size)
+        # Add source file column
+        df['source_file'] = file_name
+        compact_survey_dtypes(df)
+        logger.info(f"Successfully loaded data from {file_name} "
+                    f"({len(df)} rows in {time.perf_counter() - start:.2f}s)")
+        return df
+
+    def _read_or_reuse(self, obj, manifest: Optional[ObjectManifest]) -> pd.DataFrame:
+        """Memory-map the cached copy of an unchanged object, downloading it otherwise"""
+        if not (self.parquet_cache or manifest is not None):
+            return self.read_survey_object(obj.object_name)
+
+        path = self._parquet_cache_path(obj)
+        unchanged = manifest is None or manifest.is_current(obj)
+        if unchanged and os.path.exists(path):
+            self.wait_for_resume()
+            df = pq.read_table(path, memory_map=True).to_pandas()
+            self.metrics.record_object('extract', obj.object_name, source='cache', rows_in=len(df),
+                                       bytes_read=os.path.getsize(path))
+            logger.info(f"Reusing cached data for unchanged {obj.object_name}")
+            return df
+
+        df = self.read_survey_object(obj.object_name)
+        self._write_cache(lambda tmp_path: df.to_parquet(tmp_path, engine='pyarrow', index=False), path)
+        return df
+
+    def _try_read(self, read: Callable, obj, manifest: Optional[ObjectManifest] = None):
+        """Read a survey object with ``read(obj, manifest)``, logging and skipping it on failure"""
+        try:
+            return read(obj, manifest)
+        except Exception as e:
+            # A failure caused by a stop ends the run rather than skipping the file
+            self.wait_for_resume()
+            logger.error(f"Error loading {obj.object_name}: {str(e)}")
+            return None
 
-    def extract_survey_data(self) -> pd.DataFrame:
-        """Load survey data from MinIO"""
+    def _update_manifest(self, manifest: ObjectManifest, csv_objects: list, results: list):
+        """Record the objects read in this run and forget deleted ones"""
+        for obj, df in zip(csv_objects, results):
+            if df is not None:
+                manifest.record(obj)
+        manifest.prune(obj.object_name for obj in csv_objects)
+        manifest.save()
+
+    def _read_objects(self, read: Callable, max_workers: Optional[int], incremental: bool,
+                      cache_dir: Optional[str] = None,
+                      cache_path: Optional[Callable] = None) -> Tuple[list, int]:
+        """List the CSV objects under the source prefix and read each with ``read(obj, manifest)``
+
+        Objects are fetched by a bounded pool of ``max_workers`` threads
+        (defaults to ``extract_workers``); ``max_workers=1`` reads them serially.
+        Failed objects are skipped. In incremental mode the manifest is updated
+        afterwards, and with a ``cache_dir`` cached files that ``cache_path``
+        no longer maps a listed object to are evicted. Returns the results in
+        listing order and the number of workers used.
+        """
+        # Get list of CSV files in the bucket
+        objects = self.object_store.list_objects(self.bucket_name, prefix=self.source_prefix)
+        csv_objects = [obj for obj in objects if obj.object_name.endswith('.csv')]
+
+        if not csv_objects:
+            raise FileNotFoundError(f"No CSV files found in bucket {self.bucket_name}")
+
+        manifest = ObjectManifest(self.manifest_path) if incremental else None
+        if manifest is not None:
+            changed = sum(1 for obj in csv_objects if not manifest.is_current(obj))
+            logger.info(f"Incremental extract: {changed} of {len(csv_objects)} files new or changed")
+
+        workers = max(1, min(max_workers or self.extract_workers, len(csv_objects)))
+        try_read = lambda obj: self._try_read(read, obj, manifest)
+        if workers == 1:
+            results = [try_read(obj) for obj in csv_objects]
+        else:
+            with ThreadPoolExecutor(max_workers=workers,
+                                    thread_name_prefix='extract') as executor:
+                results = list(executor.map(try_read, csv_objects))
+
+        if not any(result is not None for result in results):
+            raise ValueError("No data could be loaded from CSV files")
+
+        if manifest is not None:
+            self._update_manifest(manifest, csv_objects, results)
+        if cache_dir is not None:
+            self._evict_cache(cache_dir, [cache_path(obj) for obj in csv_objects])
+        return [result for result in results if result is not None], workers
+
+    def extract_survey_data(self, max_workers: Optional[int] = None,
+                            incremental: Optional[bool] = None) -> pd.DataFrame:
+        """Load survey data from the object store
+
+        Objects are fetched by a bounded pool of ``max_workers`` threads
+        (defaults to ``extract_workers``); ``max_workers=1`` reads them serially.
+        Objects with a cached Parquet copy for their current ETag are read from
+        the cache; in incremental mode the manifest must also agree on size and
+        modification time. Every object ends up in the returned frame, so
+        unchanged ones are still transformed again; ``extract_survey_partials``
+        reuses their cached partial aggregates instead.
+        """
+        try:
+            with self.metrics.stage('extract'):
+                self.wait_for_resume()
+                start = time.perf_counter()
+                if incremental is None:
+                    incremental = self.incremental_extract
+
+                # Load data from each CSV file, keeping the listing order
+                cached = self.parquet_cache or incremental
+                dfs, workers = self._read_objects(self._read_or_reuse, max_workers, incremental,
+                                                  self.parquet_cache_dir if cached else None,
+                                                  self._parquet_cache_path)
+
+                # Combine all DataFrames
+                combined_df = concat_survey_frames(dfs)
+                self.metrics.count('extract', rows_out=len(combined_df))
+                logger.info(f"Survey data loaded successfully from MinIO: {len(dfs)} files "
+                            f"with {workers} workers in {time.perf_counter() - start:.2f}s")
+                return combined_df
+        except Exception as e:
+            logger.error(f"Error extracting survey data: {str(e)}")
+            raise
+
+    def read_survey_partials(self, file_name: str, spec: dict, options: dict) -> Optional[PartialAggregates]:
+        """Stream a CSV object in chunks of ``chunk_size`` rows into partial aggregates
+
+        Only one chunk of raw rows is held in memory at a time; columns of the
+        metric spec that a file lacks are treated as missing values.
+        """
+        self.wait_for_resume()
+        start = time.perf_counter()
+        required = self.grouping_cols + list(spec)
+        accumulator = PartialsAccumulator()
+        rows = 0
+        reader = self.object_store.open(self.bucket_name, file_name)
         try:
+            # A stop closes the stream to interrupt a chunk being parsed
+            with self.cancellable(reader.close):
+                for chunk in pd.read_csv(reader, chunksize=self.chunk_size):
+                    self.wait_for_resume()
+                    chunk['source_file'] = file_name
+                    compact_survey_dtypes(chunk)
+                    chunk = self.prepare_survey_frame(chunk, copy=False)
+                    for col in required:
+                        if col not in chunk.columns:
+                            chunk[col] = np.nan
+                    accumulator.add(PartialAggregates.from_frame(chunk, self.grouping_cols, spec, **options))
+                    rows += len(chunk)
+        finally:
+            reader.close()
+        self.metrics.record_object('extract', file_name, source=self.object_store.name, rows_in=rows,
+                                   bytes_read=reader.size)
+        logger.info(f"Successfully streamed data from {file_name} "
+                    f"({rows} rows in {time.perf_counter() - start:.2f}s)")
+        return accumulator.result()
+
+    def _read_or_reuse_partials(self, obj, spec: dict, options: dict,
+                                manifest: Optional[ObjectManifest]) -> Optional[PartialAggregates]:
+        """Reuse the cached partials of an unchanged object, streaming it otherwise"""
+        if manifest is None:
+            return self.read_survey_partials(obj.object_name, spec, options)
+
+        path = self._partials_cache_path(obj, options)
+        if manifest.is_current(obj) and os.path.exists(path):
             self.wait_for_resume()
-            # Get list of CSV files in the bucket
-            objects = self.minio_client.list_objects(self.bucket_name, recursive=True)
-            csv_files = [obj.object_name for obj in objects if obj.object_name.endswith('.csv')]
-            
-            if not csv_files:
-                raise FileNotFoundError("No CSV files found in MinIO bucket")
-            
-            # Load data from each CSV file
-            dfs = []
-            for file_name in csv_files:
+            logger.info(f"Reusing cached aggregates for unchanged {obj.object_name}")
+            self.metrics.record_object('extract', obj.object_name, source='cache',
+                                       bytes_read=os.path.getsize(path))
+            return pd.read_pickle(path)
+
+        partials = self.read_survey_partials(obj.object_name, spec, options)
+        if partials is not None:
+            self._write_cache(lambda tmp_path: pd.to_pickle(partials, tmp_path), path)
+        return partials
+
+    def extract_survey_partials(self, max_workers: Optional[int] = None,
+                                incremental: Optional[bool] = None,
+                                median: Optional[str] = None,
+                                distinct: Optional[str] = None) -> PartialAggregates:
+        """Stream survey data from the object store into merged partial aggregates
+
+        The out-of-core counterpart of ``extract_survey_data`` followed by
+        ``compute_partials``: files are read in chunks and never combined into
+        one frame, so peak memory is bounded by ``chunk_size`` rows per worker
+        plus the aggregate state. In incremental mode the partials of unchanged
+        objects are reused from the cache.
+        """
+        try:
+            with self.metrics.stage('extract'):
                 self.wait_for_resume()
-                try:
-                    # Get file content
-                    data = self.minio_client.get_object(self.bucket_name, file_name)
-                    # Read CSV data into DataFrame
-                    df = pd.read_csv(StringIO(data.read().decode('utf-8')))
-                    # Add source file column
-                    df['source_file'] = file_name
-                    dfs.append(df)
-                    logger.info(f"Successfully loaded data from {file_name}")
-                except Exception as e:
-                    logger.error(f"Error loading {file_name}: {str(e)}")
-                    continue
-            
-            if not dfs:
-                raise ValueError("No data could be loaded from CSV files")
-            
-            # Combine all DataFrames
-            combined_df = pd.concat(dfs, ignore_index=True)
-            logger.info("Survey data loaded successfully from MinIO")
-            return combined_df
+                start = time.perf_counter()
+                if incremental is None:
+                    incremental = self.incremental_extract
+                spec = self.survey_metric_spec()
+                options = self.partial_options(median, distinct)
+
+                read = lambda obj, manifest: self._read_or_reuse_partials(obj, spec, options, manifest)
+                parts, workers = self._read_objects(read, max_workers, incremental,
+                                                    self.partials_cache_dir if incremental else None,
+                                                    lambda obj: self._partials_cache_path(obj, options))
+
+                partials = PartialAggregates.merge_all(parts)
+                self.metrics.count('extract', rows_out=len(partials.groups))
+                logger.info(f"Survey data streamed successfully from MinIO: {len(parts)} files "
+                            f"with {workers} workers in {time.perf_counter() - start:.2f}s")
+                return partials
         except Exception as e:
             logger.error(f"Error extracting survey data: {str(e)}")
             raise
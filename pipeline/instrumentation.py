@@ -0,0 +1,204 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+def peak_rss_bytes() -> Optional[int]:
+    """High-water mark of this process's resident memory"""
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class StageMetrics:
+    """Counters of one pipeline stage
+
+    A stage may be entered by several threads at once, e.g. two concurrent
+    uploads; its wall time covers the span during which any of them was active.
+    """
+
+    COUNTERS = ('rows_in', 'rows_out', 'bytes_read', 'bytes_written', 'db_rows')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.wall_seconds = 0.0
+        self.peak_rss_bytes: Optional[int] = None
+        self.counters: Dict[str, int] = {counter: 0 for counter in self.COUNTERS}
+        # Bytes and rows per MinIO object or cache file
+        self.objects: Dict[str, Dict[str, object]] = {}
+        self._active = 0
+        self._active_since: Optional[float] = None
+
+    def wall_time(self, now: Optional[float] = None) -> float:
+        """Seconds the stage has been active, including a span still in progress"""
+        if self._active and self._active_since is not None:
+            return self.wall_seconds + (now or time.time()) - self._active_since
+        return self.wall_seconds
+
+    def to_dict(self) -> dict:
+        wall = self.wall_time()
+        result = {
+            'started': self.started,
+            'finished': self.finished,
+            'running': self._active > 0,
+            'wall_seconds': round(wall, 3),
+            'peak_rss_bytes': self.peak_rss_bytes,
+            **self.counters,
+            'objects': {name: dict(entry) for name, entry in self.objects.items()},
+        }
+        if self.counters['db_rows']:
+            result['db_rows_per_second'] = round(self.counters['db_rows'] / wall, 1) if wall else None
+        return result
+
+class JobMetrics:
+    """Thread-safe per-stage instrumentation of one pipeline job"""
+
+    def __init__(self):
+        self.stages: Dict[str, StageMetrics] = {}
+        self.paused_seconds_total = 0.0
+        self._paused_since: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _stage(self, name: str) -> StageMetrics:
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name)
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a block as part of stage ``name`` and record the peak RSS at its end"""
+        with self._lock:
+            stage = self._stage(name)
+            now = time.time()
+            if stage.started is None:
+                stage.started = now
+            if stage._active == 0:
+                stage._active_since = now
+            stage._active += 1
+        try:
+            yield stage
+        finally:
+            with self._lock:
+                now = time.time()
+                stage._active -= 1
+                if stage._active == 0:
+                    stage.wall_seconds += now - stage._active_since
+                    stage._active_since = None
+                stage.finished = now
+                stage.peak_rss_bytes = peak_rss_bytes()
+
+    def count(self, name: str, **counters: int):
+        """Add to the counters of stage ``name``"""
+        with self._lock:
+            stage = self._stage(name)
+            for counter, value in counters.items():
+                stage.counters[counter] += int(value or 0)
+
+    def record_object(self, name: str, object_name: str, source: str = 'minio', **counters: int):
+        """Record the rows and bytes of one object read or written by stage ``name``"""
+        with self._lock:
+            stage = self._stage(name)
+            entry = stage.objects.setdefault(object_name, {'source': source})
+            entry['source'] = source
+            for counter, value in counters.items():
+                entry[counter] = entry.get(counter, 0) + int(value or 0)
+                stage.counters[counter] += int(value or 0)
+
+    def paused(self):
+        """Start counting paused time"""
+        with self._lock:
+            if self._paused_since is None:
+                self._paused_since = time.time()
+
+    def resumed(self):
+        """Stop counting paused time"""
+        with self._lock:
+            if self._paused_since is not None:
+                self.paused_seconds_total += time.time() - self._paused_since
+                self._paused_since = None
+
+    def restart_pause_clock(self):
+        """Forget the time paused so far, counting a pause in progress from now"""
+        with self._lock:
+            self.paused_seconds_total = 0.0
+            if self._paused_since is not None:
+                self._paused_since = time.time()
+
+    def paused_seconds(self) -> float:
+        """Total time spent paused, including a pause still in progress"""
+        with self._lock:
+            ongoing = time.time() - self._paused_since if self._paused_since is not None else 0.0
+            return self.paused_seconds_total + ongoing
+
+    def to_dict(self) -> dict:
+        paused = self.paused_seconds()
+        with self._lock:
+            return {
+                'paused_seconds': round(paused, 3),
+                'stages': {name: stage.to_dict() for name, stage in self.stages.items()},
+            }
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+# Prometheus gauge name, help text and the StageMetrics.to_dict key it reports
+STAGE_SERIES = [
+    ('rtv_pipeline_stage_wall_seconds', 'Wall time the stage was active', 'wall_seconds'),
+    ('rtv_pipeline_stage_rows_in', 'Rows read by the stage', 'rows_in'),
+    ('rtv_pipeline_stage_rows_out', 'Rows produced by the stage', 'rows_out'),
+    ('rtv_pipeline_stage_bytes_read', 'Bytes read by the stage', 'bytes_read'),
+    ('rtv_pipeline_stage_bytes_written', 'Bytes written by the stage', 'bytes_written'),
+    ('rtv_pipeline_stage_db_rows', 'Rows loaded into the database by the stage', 'db_rows'),
+    ('rtv_pipeline_stage_db_rows_per_second', 'Database load throughput of the stage', 'db_rows_per_second'),
+    ('rtv_pipeline_stage_peak_rss_bytes', 'Process peak RSS when the stage last finished', 'peak_rss_bytes'),
+]
+
+def render_prometheus(jobs: Iterable, status_counts: Optional[Dict[str, int]] = None) -> str:
+    """Prometheus text exposition of job and stage metrics
+
+    ``jobs`` are objects with ``id``, ``status``, ``duration`` and ``metrics``.
+    ``status_counts`` gives the number of jobs in each status when ``jobs``
+    holds only some of them, e.g. those still running.
+    """
+    jobs = list(jobs)
+    lines = []
+
+    def series(name: str, kind: str, help_text: str, samples: list):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if value is not None:
+                lines.append(f"{name}{_labels(**labels)} {value}")
+
+    statuses = status_counts
+    if statuses is None:
+        statuses = {}
+        for job in jobs:
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+    series('rtv_pipeline_jobs', 'gauge', 'Pipeline jobs by status',
+           [({'status': status}, count) for status, count in sorted(statuses.items())])
+    series('rtv_pipeline_job_duration_seconds', 'gauge', 'Job run time excluding paused time',
+           [({'job_id': job.id}, round(job.duration, 3)) for job in jobs])
+    series('rtv_pipeline_job_paused_seconds', 'gauge', 'Time the job spent paused',
+           [({'job_id': job.id}, round(job.metrics.paused_seconds(), 3)) for job in jobs])
+
+    snapshots = [(job, job.metrics.to_dict()['stages']) for job in jobs]
+    for name, help_text, key in STAGE_SERIES:
+        series(name, 'gauge', help_text,
+               [({'job_id': job.id, 'stage': stage}, values.get(key))
+                for job, stages in snapshots for stage, values in stages.items()])
+    series('rtv_pipeline_process_peak_rss_bytes', 'gauge', 'Peak resident memory of the pipeline process',
+           [({}, peak_rss_bytes())])
+    return '\n'.join(lines) + '\n'
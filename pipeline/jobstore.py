@@ -0,0 +1,211 @@
+import logging
+import os
+import shutil
+import socket
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+metadata = sqlalchemy.MetaData()
+
+# Durable record of every pipeline job, shared by all pipeline processes
+pipeline_jobs = sqlalchemy.Table(
+    'pipeline_jobs', metadata,
+    sqlalchemy.Column('id', sqlalchemy.BigInteger().with_variant(sqlalchemy.Integer, 'sqlite'),
+                      primary_key=True, autoincrement=True),
+    sqlalchemy.Column('status', sqlalchemy.String(20), nullable=False),
+    sqlalchemy.Column('message', sqlalchemy.Text),
+    sqlalchemy.Column('survey_year', sqlalchemy.String(20)),
+    sqlalchemy.Column('bucket', sqlalchemy.Text),
+    sqlalchemy.Column('prefix', sqlalchemy.Text, nullable=False, default=''),
+    sqlalchemy.Column('start_time', sqlalchemy.DateTime),
+    sqlalchemy.Column('end_time', sqlalchemy.DateTime),
+    sqlalchemy.Column('duration_seconds', sqlalchemy.Float),
+    sqlalchemy.Column('metrics', sqlalchemy.JSON),
+    # Stages finished by the current run, in completion order
+    sqlalchemy.Column('checkpoints', sqlalchemy.JSON),
+    # Pause, resume or cancel requested through a process that does not run the job
+    sqlalchemy.Column('requested_action', sqlalchemy.String(20)),
+    # Process running the job and the last time it reported in (UTC)
+    sqlalchemy.Column('owner', sqlalchemy.String(200)),
+    sqlalchemy.Column('heartbeat', sqlalchemy.DateTime),
+)
+
+RECORD_FIELDS = ('id', 'status', 'message', 'survey_year', 'bucket', 'prefix',
+                 'start_time', 'end_time', 'duration_seconds')
+
+def process_owner() -> str:
+    """Identifier of this pipeline process"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def record_summary(row) -> dict:
+    """JSON-serializable job summary from a pipeline_jobs row"""
+    record = {field: row[field] for field in RECORD_FIELDS}
+    for field in ('start_time', 'end_time'):
+        if record[field] is not None:
+            record[field] = record[field].isoformat()
+    record['duration_seconds'] = round(record['duration_seconds'] or 0, 3)
+    return record
+
+class JobStore:
+    """Pipeline jobs persisted in a database table
+
+    Ids are allocated by the database, so several pipeline processes can
+    share one store. A process owns the jobs it runs and refreshes their
+    heartbeat; active jobs whose heartbeat goes stale are claimed and resumed
+    by another process.
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.Engine, owner: Optional[str] = None):
+        self.engine = engine
+        self.owner = owner or process_owner()
+
+    def ensure_schema(self):
+        """Create the jobs table if it does not exist yet"""
+        metadata.create_all(self.engine, checkfirst=True)
+
+    def create(self, status: str, message: str, survey_year: str, bucket: str, prefix: str) -> int:
+        """Insert a job owned by this process and return its id"""
+        with self.engine.begin() as connection:
+            result = connection.execute(pipeline_jobs.insert().values(
+                status=status, message=message, survey_year=survey_year, bucket=bucket,
+                prefix=prefix, start_time=datetime.now(), checkpoints=[],
+                owner=self.owner, heartbeat=datetime.utcnow()))
+            return result.inserted_primary_key[0]
+
+    def save(self, job_id: int, **values):
+        """Update the stored fields of a job and refresh its heartbeat"""
+        with self.engine.begin() as connection:
+            connection.execute(pipeline_jobs.update()
+                               .where(pipeline_jobs.c.id == job_id)
+                               .values(heartbeat=datetime.utcnow(), **values))
+
+    def get(self, job_id: int) -> Optional[dict]:
+        """Summary of a stored job, with its metrics"""
+        with self.engine.connect() as connection:
+            row = connection.execute(pipeline_jobs.select()
+                                     .where(pipeline_jobs.c.id == job_id)).mappings().first()
+        if row is None:
+            return None
+        return {**record_summary(row), **(row['metrics'] or {})}
+
+    def page(self, page: int, per_page: int) -> Tuple[List[dict], int]:
+        """Summaries of one page of jobs, newest first, and the total number of jobs"""
+        with self.engine.connect() as connection:
+            total = connection.execute(sqlalchemy.select(sqlalchemy.func.count())
+                                       .select_from(pipeline_jobs)).scalar()
+            rows = connection.execute(pipeline_jobs.select()
+                                      .order_by(pipeline_jobs.c.id.desc())
+                                      .limit(per_page).offset((page - 1) * per_page)).mappings().all()
+        return [record_summary(row) for row in rows], total
+
+    def status_counts(self) -> Dict[str, int]:
+        """Number of stored jobs in each status"""
+        with self.engine.connect() as connection:
+            rows = connection.execute(sqlalchemy.select(pipeline_jobs.c.status, sqlalchemy.func.count())
+                                      .group_by(pipeline_jobs.c.status)).all()
+        return {status: count for status, count in rows}
+
+    def active(self, statuses: Iterable[str]) -> List[dict]:
+        """Summaries of jobs in any of ``statuses``, whichever process runs them"""
+        with self.engine.connect() as connection:
+            rows = connection.execute(pipeline_jobs.select()
+                                      .where(pipeline_jobs.c.status.in_(list(statuses)))).mappings().all()
+        return [record_summary(row) for row in rows]
+
+    def heartbeat(self, job_ids: List[int]) -> Dict[int, Optional[str]]:
+        """Refresh the heartbeat of owned jobs and collect their requested actions
+
+        Returns the requested action of every job, clearing it in the same
+        transaction so it is applied once.
+        """
+        if not job_ids:
+            return {}
+        with self.engine.begin() as connection:
+            owned = (pipeline_jobs.c.id.in_(job_ids)) & (pipeline_jobs.c.owner == self.owner)
+            connection.execute(pipeline_jobs.update().where(owned).values(heartbeat=datetime.utcnow()))
+            rows = connection.execute(sqlalchemy.select(pipeline_jobs.c.id, pipeline_jobs.c.requested_action)
+                                      .where(owned & pipeline_jobs.c.requested_action.isnot(None))).all()
+            if rows:
+                connection.execute(pipeline_jobs.update()
+                                   .where(pipeline_jobs.c.id.in_([row[0] for row in rows]))
+                                   .values(requested_action=None))
+        return {job_id: action for job_id, action in rows}
+
+    def request_action(self, job_id: int, action: str, statuses: Iterable[str]) -> bool:
+        """Ask the process running an active job to pause, resume or cancel it"""
+        with self.engine.begin() as connection:
+            result = connection.execute(pipeline_jobs.update()
+                                        .where((pipeline_jobs.c.id == job_id)
+                                               & pipeline_jobs.c.status.in_(list(statuses)))
+                                        .values(requested_action=action))
+        return result.rowcount > 0
+
+    def claim_stale(self, statuses: Iterable[str], stale_after: float, include_own: bool = False) -> List[dict]:
+        """Take over active jobs whose owner stopped sending heartbeats
+
+        Each job is claimed with a conditional update, so only one process
+        wins it. ``include_own`` also claims jobs already recorded under this
+        process's owner name whatever their heartbeat. Returns the claimed rows.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+        stale = pipeline_jobs.c.heartbeat.is_(None) | (pipeline_jobs.c.heartbeat < cutoff)
+        if include_own:
+            stale = stale | (pipeline_jobs.c.owner == self.owner)
+        else:
+            stale = stale & ((pipeline_jobs.c.owner != self.owner) | pipeline_jobs.c.owner.is_(None))
+        stale = pipeline_jobs.c.status.in_(list(statuses)) & stale
+        with self.engine.connect() as connection:
+            candidates = connection.execute(pipeline_jobs.select().where(stale)).mappings().all()
+        claimed = []
+        for row in candidates:
+            with self.engine.begin() as connection:
+                result = connection.execute(pipeline_jobs.update()
+                                            .where((pipeline_jobs.c.id == row['id'])
+                                                   & (pipeline_jobs.c.owner.is_(None)
+                                                      | (pipeline_jobs.c.owner == row['owner']))
+                                                   & stale)
+                                            .values(owner=self.owner, heartbeat=datetime.utcnow(),
+                                                    requested_action=None))
+            if result.rowcount:
+                claimed.append(dict(row))
+        return claimed
+
+    def changed_since(self, since: datetime) -> List[int]:
+        """Ids of jobs owned by other processes that reported in after ``since`` (UTC)"""
+        with self.engine.connect() as connection:
+            rows = connection.execute(sqlalchemy.select(pipeline_jobs.c.id)
+                                      .where((pipeline_jobs.c.heartbeat > since)
+                                             & (pipeline_jobs.c.owner != self.owner))).all()
+        return [row[0] for row in rows]
+
+class StageCheckpoints:
+    """Outputs of completed stages of one job, kept on disk until the job finishes"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, stage: str) -> str:
+        return os.path.join(self.directory, f"{stage}.pkl")
+
+    def save(self, stage: str, result):
+        """Write a stage's output; stages without output only need their checkpoint entry"""
+        if result is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._path(stage) + '.tmp'
+        pd.to_pickle(result, tmp_path)
+        os.replace(tmp_path, self._path(stage))
+
+    def has(self, stage: str) -> bool:
+        return os.path.exists(self._path(stage))
+
+    def load(self, stage: str):
+        return pd.read_pickle(self._path(stage)) if self.has(stage) else None
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from typing import Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+class ObjectManifest:
+    """Persisted record of the survey objects that have already been processed"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = self._read()
+
+    def _read(self) -> Dict[str, dict]:
+        """Read the manifest file, starting empty if it is missing or unreadable"""
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable manifest {self.path}: {str(e)}")
+            return {}
+
+    @staticmethod
+    def describe(obj) -> dict:
+        """Metadata used to decide whether an object changed since the last run"""
+        last_modified = obj.last_modified
+        if isinstance(last_modified, datetime):
+            last_modified = last_modified.isoformat()
+        return {
+            'name': obj.object_name,
+            'etag': obj.etag,
+            'size': obj.size,
+            'last_modified': last_modified,
+        }
+
+    @staticmethod
+    def cache_key(name: str, etag: str) -> str:
+        """Stable file-system key for one version of an object"""
+        return hashlib.sha1(f"{name}:{etag}".encode('utf-8')).hexdigest()
+
+    def is_current(self, obj) -> bool:
+        """Return True if the object is unchanged since it was recorded"""
+        return self.entries.get(obj.object_name) == self.describe(obj)
+
+    def record(self, obj):
+        """Mark an object version as processed"""
+        self.entries[obj.object_name] = self.describe(obj)
+
+    def prune(self, names: Iterable[str]) -> list:
+        """Drop entries for objects that are no longer listed, returning them"""
+        keep = set(names)
+        removed = [self.entries.pop(name) for name in list(self.entries) if name not in keep]
+        return removed
+
+    def save(self):
+        """Atomically write the manifest to disk"""
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
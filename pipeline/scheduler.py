@@ -0,0 +1,93 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class Stage(NamedTuple):
+    """One step of a job, run with the results of the stages it depends on"""
+    run: Callable[[Dict[str, object]], object]
+    after: Tuple[str, ...] = ()
+
+def run_stages(stages: Dict[str, Stage], executor: Optional[ThreadPoolExecutor] = None,
+               completed: Optional[Dict[str, object]] = None,
+               on_complete: Optional[Callable[[str, object], None]] = None) -> Dict[str, object]:
+    """Run a DAG of stages, starting each one as soon as its dependencies finish
+
+    Each stage's ``run`` receives the results of all finished stages. The first
+    failure stops new stages from starting; stages already running are waited
+    for before the error is raised. Without an ``executor`` a private one
+    with one thread per stage is used.
+
+    Stages in ``completed`` are not run again and their results are used as
+    given. ``on_complete`` is called with each stage's name and result as it
+    finishes, before any stage depending on it starts.
+    """
+    unknown = {dep for stage in stages.values() for dep in stage.after if dep not in stages}
+    if unknown:
+        raise ValueError(f"Stages depend on unknown stages: {sorted(unknown)}")
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max(1, len(stages)), thread_name_prefix='stage')
+    results: Dict[str, object] = dict(completed or {})
+    pending = {name: stage for name, stage in stages.items() if name not in results}
+    running: Dict[Future, str] = {}
+    error: Optional[BaseException] = None
+    try:
+        while pending or running:
+            if error is None:
+                ready = [name for name, stage in pending.items()
+                         if all(dep in results for dep in stage.after)]
+                for name in ready:
+                    stage = pending.pop(name)
+                    running[executor.submit(stage.run, dict(results))] = name
+            if not running:
+                if pending and error is None:
+                    raise ValueError(f"Stages have circular dependencies: {sorted(pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                    if on_complete:
+                        on_complete(name, result)
+                    results[name] = result
+                except BaseException as e:
+                    # Keep the first failure, later ones are usually its consequence
+                    if error is None:
+                        error = e
+                        logger.error(f"Stage {name} failed: {str(e)}")
+        if error is not None:
+            raise error
+        return results
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+
+class PipelineScheduler:
+    """Bounded pool of pipeline workers fed from a FIFO job queue
+
+    At most ``max_jobs`` jobs run at once, the rest wait in submission order.
+    Stages of running jobs share a separate pool of ``stage_workers`` threads,
+    so a job waiting on its stages never holds up another job's stages.
+    """
+
+    def __init__(self, max_jobs: int, stage_workers: int):
+        self.max_jobs = max_jobs
+        self.stage_workers = stage_workers
+        self._job_executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='pipeline')
+        self.stage_executor = ThreadPoolExecutor(max_workers=stage_workers, thread_name_prefix='stage')
+
+    def submit(self, job) -> Future:
+        """Queue a job's ``run_pipeline`` for the next free worker"""
+        future = self._job_executor.submit(job.run_pipeline)
+        logger.info(f"Queued pipeline {job.id}")
+        return future
+
+    def shutdown(self):
+        """Stop accepting jobs, drop queued ones and wait for running jobs"""
+        self._job_executor.shutdown(wait=True, cancel_futures=True)
+        self.stage_executor.shutdown(wait=True)
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+# HyperLogLog sketches of distinct values, one row of registers per group.
+# A precision of p keeps 2 ** p one-byte registers per group with a relative
+# standard error of about 1.04 / sqrt(2 ** p).
+DEFAULT_HLL_PRECISION = 11
+
+def _hash_values(values: pd.Series) -> np.ndarray:
+    """64-bit hashes of values, treating equal ints and floats alike"""
+    if is_numeric_dtype(values.dtype) and not is_bool_dtype(values.dtype):
+        values = values.astype('float64')
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+def _leading_zeros(x: np.ndarray) -> np.ndarray:
+    """Count leading zero bits of non-zero uint64 values"""
+    zeros = np.zeros(len(x), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_clear = x < (np.uint64(1) << np.uint64(64 - shift))
+        zeros[top_clear] += shift
+        x = np.where(top_clear, x << np.uint64(shift), x)
+    return zeros
+
+def hll_registers(gids: np.ndarray, values, n_groups: int,
+                  precision: int = DEFAULT_HLL_PRECISION) -> np.ndarray:
+    """Build per-group HyperLogLog registers from row group ids and values"""
+    width = 1 << precision
+    registers = np.zeros((n_groups, width), dtype=np.uint8)
+    values = pd.Series(values)
+    valid = (gids >= 0) & values.notna().to_numpy()
+    if not valid.any():
+        return registers
+
+    hashes = _hash_values(values[valid].reset_index(drop=True))
+    buckets = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    # A sentinel bit caps the rank when the remaining bits are all zero
+    remaining = (hashes << np.uint64(precision)) | (np.uint64(1) << np.uint64(precision - 1))
+    ranks = _leading_zeros(remaining) + 1
+
+    cells = gids[valid].astype(np.int64) * width + buckets
+    best = pd.Series(ranks).groupby(cells).max()
+    registers.reshape(-1)[best.index.to_numpy()] = best.to_numpy()
+    return registers
+
+def hll_merge(registers: np.ndarray, gids: np.ndarray, n_groups: int) -> np.ndarray:
+    """Merge register rows that map to the same new group id"""
+    merged = pd.DataFrame(registers).groupby(gids).max()
+    return merged.reindex(range(n_groups), fill_value=0).to_numpy(dtype=np.uint8)
+
+def hll_estimate(registers: np.ndarray) -> np.ndarray:
+    """Estimated distinct count for every row of registers"""
+    width = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / width)
+    raw = alpha * width * width / np.sum(np.exp2(-registers.astype(np.float64)), axis=1)
+    empty = np.count_nonzero(registers == 0, axis=1)
+    # Linear counting is more accurate while many registers are still empty
+    small = (raw <= 2.5 * width) & (empty > 0)
+    raw[small] = width * np.log(width / empty[small])
+    return np.rint(raw).astype(np.int64)
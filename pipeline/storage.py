@@ -0,0 +1,175 @@
+import hashlib
+import io
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Backends selectable with STORAGE_BACKEND
+STORAGE_BACKENDS = ('minio', 'local')
+
+class StoredObject(NamedTuple):
+    """Listing entry of an object store"""
+    object_name: str
+    etag: str
+    size: int
+    last_modified: Optional[datetime]
+
+class ObjectReader:
+    """Byte stream of one stored object
+
+    File-like enough for ``pd.read_csv``. ``close`` may be called from
+    another thread to interrupt a read in progress.
+    """
+
+    def __init__(self, stream, size: Optional[int], on_close=None):
+        self._stream = stream
+        # Object size in bytes, when the store reports it
+        self.size = size
+        self._on_close = on_close
+
+    def read(self, size: int = -1) -> bytes:
+        return self._stream.read(size)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def close(self):
+        self._stream.close()
+        if self._on_close:
+            self._on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ObjectStore(ABC):
+    """Buckets of survey files and results, independent of where they are kept"""
+
+    # Recorded as the source of objects read from the store
+    name = 'store'
+
+    @abstractmethod
+    def list_objects(self, bucket_name: str, prefix: str = '') -> Iterator[StoredObject]:
+        """Objects in a bucket whose names start with ``prefix``, at any depth"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def open(self, bucket_name: str, object_name: str) -> ObjectReader:
+        """Stream an object's bytes"""
+        raise NotImplementedError
+
+    def get(self, bucket_name: str, object_name: str) -> bytes:
+        """Read a whole object"""
+        with self.open(bucket_name, object_name) as reader:
+            return reader.read()
+
+    @abstractmethod
+    def put_stream(self, bucket_name: str, object_name: str, stream: BinaryIO,
+                   content_type: str = 'application/octet-stream', part_size: int = 16 * 1024 * 1024):
+        """Write an object from a stream of unknown length, replacing any previous version whole"""
+        raise NotImplementedError
+
+    def put(self, bucket_name: str, object_name: str, data: bytes,
+            content_type: str = 'application/octet-stream'):
+        """Write an object from bytes"""
+        self.put_stream(bucket_name, object_name, io.BytesIO(data), content_type)
+
+class MinioStore(ObjectStore):
+    """Object store backed by a MinIO client"""
+
+    name = 'minio'
+
+    def __init__(self, client):
+        self.client = client
+
+    def list_objects(self, bucket_name: str, prefix: str = '') -> Iterator[StoredObject]:
+        for obj in self.client.list_objects(bucket_name, prefix=prefix or None, recursive=True):
+            yield StoredObject(obj.object_name, obj.etag, obj.size, obj.last_modified)
+
+    def open(self, bucket_name: str, object_name: str) -> ObjectReader:
+        response = self.client.get_object(bucket_name, object_name)
+        size = response.headers.get('Content-Length')
+        return ObjectReader(response, int(size) if size is not None else None,
+                            on_close=response.release_conn)
+
+    def put_stream(self, bucket_name: str, object_name: str, stream: BinaryIO,
+                   content_type: str = 'application/octet-stream', part_size: int = 16 * 1024 * 1024):
+        # Multipart upload, parts are read from the stream as they are sent
+        self.client.put_object(bucket_name, object_name, data=stream, length=-1,
+                               part_size=part_size, content_type=content_type)
+
+class LocalStore(ObjectStore):
+    """Object store on the local filesystem, one directory per bucket under ``root``
+
+    Objects are memory-mapped for reading, so co-located survey files are
+    parsed straight from the page cache without an HTTP round trip. Writes go
+    to a temporary file renamed into place, so readers never see a partial
+    object.
+    """
+
+    name = 'local'
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket_name: str, object_name: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, bucket_name, *object_name.split('/')))
+        if not path.startswith(os.path.normpath(os.path.join(self.root, bucket_name)) + os.sep):
+            raise ValueError(f"Object name {object_name!r} is outside bucket {bucket_name!r}")
+        return path
+
+    def list_objects(self, bucket_name: str, prefix: str = '') -> Iterator[StoredObject]:
+        bucket_dir = os.path.join(self.root, bucket_name)
+        if not os.path.isdir(bucket_dir):
+            raise FileNotFoundError(f"Bucket directory {bucket_dir} does not exist")
+        for directory, directories, file_names in os.walk(bucket_dir, followlinks=True):
+            directories.sort()
+            for file_name in sorted(file_names):
+                if file_name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, file_name)
+                object_name = os.path.relpath(path, bucket_dir).replace(os.sep, '/')
+                if prefix and not object_name.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                # Changes whenever the file is rewritten, as an ETag would
+                etag = hashlib.md5(f"{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()
+                yield StoredObject(object_name, etag, stat.st_size,
+                                   datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+
+    def open(self, bucket_name: str, object_name: str) -> ObjectReader:
+        with open(self._path(bucket_name, object_name), 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                # Empty files cannot be mapped
+                return ObjectReader(io.BytesIO(), 0)
+            # The mapping stays valid after the file descriptor is closed
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        return ObjectReader(mapped, size)
+
+    def put_stream(self, bucket_name: str, object_name: str, stream: BinaryIO,
+                   content_type: str = 'application/octet-stream', part_size: int = 16 * 1024 * 1024):
+        path = self._path(bucket_name, object_name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                shutil.copyfileobj(stream, output, part_size)
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -1,101 +1,302 @@
+import numpy as np
 import pandas as pd
-from typing import Optional
-from datetime import datetime
+import pyarrow as pa
+from concurrent.futures import FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
 import logging
+import os
+from aggregates import MODE, PartialAggregates
+from duckdb_engine import survey_metrics
+from sketches import DEFAULT_HLL_PRECISION
 from load import DataLoader
+from resources import ResourceRegistry
 
 logger = logging.getLogger(__name__)
 
+# Engines selectable with TRANSFORM_ENGINE
+TRANSFORM_ENGINES = ('pandas', 'duckdb')
+
+def share_frame(df: pd.DataFrame) -> Tuple[shared_memory.SharedMemory, int]:
+    """Write a frame as an Arrow IPC stream into a new shared memory block"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sizer = pa.MockOutputStream()
+    with pa.ipc.new_stream(sizer, table.schema) as writer:
+        writer.write_table(table)
+    size = sizer.size()
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        sink = pa.FixedSizeBufferWriter(pa.py_buffer(block.buf))
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    return block, size
+
+def read_shared_frame(name: str, size: int) -> pd.DataFrame:
+    """Read a frame written by ``share_frame``, typically in another process"""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        # One memcpy out of the block; zero-copy columns would pin it open
+        buffer = pa.py_buffer(block.buf[:size].tobytes())
+    finally:
+        block.close()
+    return pa.ipc.open_stream(buffer).read_all().to_pandas()
+
+def shard_partials(name: str, size: int, keys: List[str], spec: Dict[str, List[str]],
+                   options: dict) -> PartialAggregates:
+    """Worker process entry point: partial aggregates of one shared shard"""
+    return PartialAggregates.from_frame(read_shared_frame(name, size), keys, spec, **options)
+
+def balance_shards(sizes: pd.Series, n_shards: int) -> List[list]:
+    """Spread shard keys over at most ``n_shards`` bins of similar row counts, largest first"""
+    bins = [[] for _ in range(min(n_shards, len(sizes)))]
+    totals = np.zeros(len(bins), dtype=np.int64)
+    for key, rows in sizes.sort_values(ascending=False, kind='mergesort').items():
+        smallest = int(np.argmin(totals))
+        bins[smallest].append(key)
+        totals[smallest] += rows
+    return [keys for keys in bins if keys]
+
 class DataTransformer(DataLoader):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, resources: Optional[ResourceRegistry] = None):
+        super().__init__(resources)
+        # Finest grouping level, every other level is rolled up from it
+        self.grouping_cols = ['district', 'Quartile', 'source_file']
+        # Coarser output levels derived from the detailed partial aggregates
+        self.rollups = {'overall_metrics': ['district', 'Quartile']}
+        # 'exact' keeps full value distributions for medians, 'approx' bins them
+        self.median_mode = os.getenv('MEDIAN_MODE', 'exact')
+        self.median_precision = int(os.getenv('MEDIAN_PRECISION', '1'))
+        # 'exact' keeps every distinct value, 'approx' keeps HyperLogLog sketches
+        self.distinct_mode = os.getenv('DISTINCT_MODE', 'exact')
+        self.distinct_precision = int(os.getenv('DISTINCT_PRECISION', str(DEFAULT_HLL_PRECISION)))
+        # Stream each file in chunks of this many rows instead of combining all files
+        self.streaming_transform = os.getenv('STREAMING_TRANSFORM', '0') == '1'
+        self.chunk_size = int(os.getenv('TRANSFORM_CHUNK_SIZE', '100000'))
+        # Worker processes for the in-memory transform, 1 keeps it in the calling thread
+        self.transform_workers = int(os.getenv('TRANSFORM_WORKERS', '1'))
+        # Grouping column the frame is split on, shards never share a group
+        self.shard_column = os.getenv('TRANSFORM_SHARD_BY', 'district')
+        if self.shard_column not in self.grouping_cols:
+            raise ValueError(f"TRANSFORM_SHARD_BY must be one of {self.grouping_cols}, got {self.shard_column!r}")
+        # 'pandas' aggregates partials, 'duckdb' runs the metric spec as multi-threaded SQL
+        self.transform_engine = os.getenv('TRANSFORM_ENGINE', 'pandas').lower()
+        if self.transform_engine not in TRANSFORM_ENGINES:
+            raise ValueError(f"TRANSFORM_ENGINE must be one of {TRANSFORM_ENGINES}, got {self.transform_engine!r}")
+        # Threads of the DuckDB engine, 0 uses one per core
+        self.duckdb_threads = int(os.getenv('DUCKDB_THREADS', '0'))
 
-    def transform_survey_data(self, df: pd.DataFrame) -> dict:
-        """Transform survey data into meaningful metrics"""
-        try:
+    def prepare_survey_frame(self, df: pd.DataFrame, copy: bool = True) -> pd.DataFrame:
+        """Parse date columns and derive the survey duration"""
+        if copy:
             # Create a copy to avoid fragmentation warnings
             df = df.copy()
-            
-            # Convert date columns to datetime if they exist
-            self.wait_for_resume()
-            datetime_cols = ['SubmissionDate', 'starttime', 'endtime']
-            for col in datetime_cols:
-                self.wait_for_resume()
-                if col in df.columns:
-                    df[col] = pd.to_datetime(df[col])
-            
-            # Calculate survey duration if datetime columns exist
-            self.wait_for_resume()
-            if 'starttime' in df.columns and 'endtime' in df.columns:
-                df['survey_duration'] = (df['endtime'] - df['starttime']).dt.total_seconds() / 60
-            
-            # Get available grouping columns
+
+        # Convert date columns to datetime if they exist
+        self.wait_for_resume()
+        datetime_cols = ['SubmissionDate', 'starttime', 'endtime']
+        for col in datetime_cols:
             self.wait_for_resume()
-            grouping_cols = ['district', 'Quartile', 'source_file']
-            available_cols = [col for col in grouping_cols if col in df.columns]
-            
-            # Define metrics to calculate
-            metrics = {
-                'household': {
-                    'hhid_2': 'nunique',
-                    'hh_size': ['mean', 'median'],
-                    'hhh_age': ['mean', 'median'],
-                    'hhh_sex': lambda x: x.value_counts().idxmax() if len(x.value_counts()) > 0 else None,
-                    'survey_duration': ['mean', 'median'] if 'survey_duration' in df.columns else None,
-                    'GPS-Accuracy': 'mean' if 'GPS-Accuracy' in df.columns else None
-                },
-                'education': {
-                    'hhh_educ_level': lambda x: x.value_counts().idxmax() if len(x.value_counts()) > 0 else None,
-                    'hhh_read_write': 'mean' if 'hhh_read_write' in df.columns else None,
-                    'age_6_12_Attend_Sch_1': 'mean' if 'age_6_12_Attend_Sch_1' in df.columns else None,
-                    'age_13_18_Attend_Sch_1': 'mean' if 'age_13_18_Attend_Sch_1' in df.columns else None
-                },
-                'assets': {
-                    'Number_Radios': ['mean', 'sum'] if 'Number_Radios' in df.columns else None,
-                    'Number_Mobile_Phones': ['mean', 'sum'] if 'Number_Mobile_Phones' in df.columns else None,
-                    'assets_reported_total': ['mean', 'sum'] if 'assets_reported_total' in df.columns else None
-                }
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col])
+
+        # Calculate survey duration if datetime columns exist
+        self.wait_for_resume()
+        if 'starttime' in df.columns and 'endtime' in df.columns:
+            df['survey_duration'] = (df['endtime'] - df['starttime']).dt.total_seconds() / 60
+        return df
+
+    def survey_metric_spec(self, columns=None) -> Dict[str, List[str]]:
+        """Aggregations to compute for each survey column present in ``columns``
+
+        Without ``columns`` every optional metric is included.
+        """
+        columns = set(columns) if columns is not None else None
+        has = lambda col: columns is None or col in columns
+        # Define metrics to calculate
+        metrics = {
+            'household': {
+                'hhid_2': ['nunique'],
+                'hh_size': ['mean', 'median'],
+                'hhh_age': ['mean', 'median'],
+                'hhh_sex': [MODE],
+                'survey_duration': ['mean', 'median'] if has('survey_duration') else None,
+                'GPS-Accuracy': ['mean'] if has('GPS-Accuracy') else None
+            },
+            'education': {
+                'hhh_educ_level': [MODE],
+                'hhh_read_write': ['mean'] if has('hhh_read_write') else None,
+                'age_6_12_Attend_Sch_1': ['mean'] if has('age_6_12_Attend_Sch_1') else None,
+                'age_13_18_Attend_Sch_1': ['mean'] if has('age_13_18_Attend_Sch_1') else None
+            },
+            'assets': {
+                'Number_Radios': ['mean', 'sum'] if has('Number_Radios') else None,
+                'Number_Mobile_Phones': ['mean', 'sum'] if has('Number_Mobile_Phones') else None,
+                'assets_reported_total': ['mean', 'sum'] if has('assets_reported_total') else None
             }
-            
-            # Remove None values from metrics
-            self.wait_for_resume()
-            metrics = {k: {k2: v2 for k2, v2 in v.items() if v2 is not None} 
-                      for k, v in metrics.items()}
-            
-            # Calculate metrics
-            detailed_metrics = pd.DataFrame()
-            overall_metrics = pd.DataFrame()
-            
-            if available_cols:
-                # Calculate detailed metrics
-                detailed_metrics = df.groupby(available_cols).agg({
-                    **metrics['household'],
-                    **metrics['education'],
-                    **metrics['assets']
-                }).reset_index()
-                
-                # Flatten multi-level columns
-                detailed_metrics.columns = ['_'.join(col).strip() if isinstance(col, tuple) else col 
-                                         for col in detailed_metrics.columns.values]
-                
+        }
+
+        # Remove None values from metrics
+        metrics = {k: {k2: v2 for k2, v2 in v.items() if v2 is not None}
+                   for k, v in metrics.items()}
+        return {**metrics['household'], **metrics['education'], **metrics['assets']}
+
+    def partial_options(self, median: Optional[str] = None, distinct: Optional[str] = None) -> dict:
+        """Median and distinct-count settings for PartialAggregates"""
+        return {
+            'median': median or self.median_mode,
+            'median_precision': self.median_precision,
+            'distinct': distinct or self.distinct_mode,
+            'distinct_precision': self.distinct_precision,
+        }
+
+    def compute_partials(self, df: pd.DataFrame, median: Optional[str] = None,
+                         distinct: Optional[str] = None,
+                         spec: Optional[Dict[str, List[str]]] = None) -> Optional[PartialAggregates]:
+        """Partial aggregates of prepared survey rows at the finest grouping level"""
+        available_cols = [col for col in self.grouping_cols if col in df.columns]
+        if not available_cols:
+            return None
+        self.wait_for_resume()
+        return PartialAggregates.from_frame(
+            df, available_cols, spec or self.survey_metric_spec(df.columns),
+            **self.partial_options(median, distinct))
+
+    def compute_partials_parallel(self, df: pd.DataFrame, workers: int,
+                                  median: Optional[str] = None,
+                                  distinct: Optional[str] = None) -> Optional[PartialAggregates]:
+        """Partial aggregates computed by worker processes, one shard of ``shard_column`` values each
+
+        Shards are handed over as Arrow IPC streams in shared memory and never
+        share a group, so merging their partials gives exactly the serial result.
+        """
+        available_cols = [col for col in self.grouping_cols if col in df.columns]
+        if self.shard_column not in available_cols:
+            return self.compute_partials(df, median=median, distinct=distinct)
+        spec = self.survey_metric_spec(df.columns)
+        options = self.partial_options(median, distinct)
+
+        # Rows with a missing shard key belong to no group and are left out
+        self.wait_for_resume()
+        codes, _ = pd.factorize(df[self.shard_column])
+        sizes = pd.Series(codes[codes >= 0]).value_counts()
+        shards = balance_shards(sizes, workers * 2)
+        if len(shards) <= 1:
+            return self.compute_partials(df, median=median, distinct=distinct, spec=spec)
+
+        pool = self.resources.process_pool(workers)
+        blocks = []
+        futures = set()
+        try:
+            for shard in shards:
                 self.wait_for_resume()
-                # Calculate overall metrics
-                overall_metrics = df.groupby(['district', 'Quartile']).agg({
-                    **metrics['household'],
-                    **metrics['education'],
-                    **metrics['assets']
-                }).reset_index()
-                
-                # Flatten overall metrics columns
+                block, size = share_frame(df[np.isin(codes, shard)])
+                blocks.append(block)
+                futures.add(pool.submit(shard_partials, block.name, size, available_cols, spec, options))
+            parts = []
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                parts.extend(future.result() for future in done)
                 self.wait_for_resume()
-                overall_metrics.columns = ['_'.join(col).strip() if isinstance(col, tuple) else col 
-                                        for col in overall_metrics.columns.values]
-            
-            logger.info("Survey data transformed successfully")
-            return {
-                'detailed_metrics': detailed_metrics,
-                'overall_metrics': overall_metrics
-            }
+            return PartialAggregates.merge_all(parts)
+        finally:
+            for future in futures:
+                future.cancel()
+            # Let running workers finish with their blocks before unlinking them
+            wait(futures)
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def transform_partials(self, partials: Optional[PartialAggregates],
+                           rollups: Optional[Dict[str, List[str]]] = None) -> dict:
+        """Finalize detailed metrics and every rollup level from partial aggregates"""
+        rollups = self.rollups if rollups is None else rollups
+        if partials is None:
+            return {'detailed_metrics': pd.DataFrame(), **{name: pd.DataFrame() for name in rollups}}
+
+        with self.metrics.stage('transform'):
+            self.wait_for_resume()
+            result = {'detailed_metrics': partials.finalize()}
+            for name, keys in rollups.items():
+                self.wait_for_resume()
+                # An empty key list rolls everything up into a single row
+                if all(key in partials.keys for key in keys):
+                    result[name] = partials.rollup(keys).finalize()
+                else:
+                    result[name] = pd.DataFrame()
+            self.metrics.count('transform', rows_out=sum(len(frame) for frame in result.values()))
+        return result
+
+    def transform_with_duckdb(self, df: pd.DataFrame, median: Optional[str] = None,
+                              distinct: Optional[str] = None,
+                              rollups: Optional[Dict[str, List[str]]] = None) -> dict:
+        """Detailed metrics and every rollup level computed by DuckDB from unprepared rows
+
+        Only the columns the metric spec reads are handed over, without copying
+        the frame; the survey duration is derived as in ``prepare_survey_frame``.
+        """
+        rollups = self.rollups if rollups is None else rollups
+        available_cols = [col for col in self.grouping_cols if col in df.columns]
+        if not available_cols:
+            return {'detailed_metrics': pd.DataFrame(), **{name: pd.DataFrame() for name in rollups}}
+
+        self.wait_for_resume()
+        derived = {}
+        if 'starttime' in df.columns and 'endtime' in df.columns:
+            duration = pd.to_datetime(df['endtime']) - pd.to_datetime(df['starttime'])
+            derived['survey_duration'] = duration.dt.total_seconds() / 60
+        spec = self.survey_metric_spec(list(df.columns) + list(derived))
+        columns = {col: derived[col] if col in derived else df[col]
+                   for col in dict.fromkeys(available_cols + list(spec))}
+        # Rollups over keys the frame lacks stay empty, as in ``transform_partials``
+        levels = {'detailed_metrics': available_cols,
+                  **{name: keys for name, keys in rollups.items()
+                     if all(key in available_cols for key in keys)}}
+        options = self.partial_options(median, distinct)
+
+        with self.metrics.stage('transform'):
+            self.wait_for_resume()
+            frames = survey_metrics(columns, levels, spec, threads=self.duckdb_threads,
+                                    median=options['median'], median_precision=options['median_precision'],
+                                    distinct=options['distinct'])
+            result = {name: frames.get(name, pd.DataFrame()) for name in ['detailed_metrics', *rollups]}
+            self.metrics.count('transform', rows_out=sum(len(frame) for frame in result.values()))
+        return result
+
+    def transform_survey_data(self, df: pd.DataFrame, median: Optional[str] = None,
+                              distinct: Optional[str] = None,
+                              rollups: Optional[Dict[str, List[str]]] = None) -> dict:
+        """Transform survey data into meaningful metrics
+
+        Raw rows are scanned once to build partial aggregates per district,
+        quartile and source file, split over ``transform_workers`` processes
+        when that is above one; ``overall_metrics`` and any other ``rollups``
+        are derived from those partials. With ``transform_engine`` 'duckdb'
+        every level is computed by DuckDB instead. ``median`` and ``distinct``
+        select 'exact' or 'approx' state and default to ``median_mode`` and
+        ``distinct_mode``.
+        """
+        try:
+            with self.metrics.stage('transform'):
+                self.metrics.count('transform', rows_in=len(df))
+                if self.transform_engine == 'duckdb':
+                    result = self.transform_with_duckdb(df, median=median, distinct=distinct,
+                                                        rollups=rollups)
+                    logger.info("Survey data transformed successfully")
+                    return result
+                df = self.prepare_survey_frame(df)
+                if self.transform_workers > 1:
+                    partials = self.compute_partials_parallel(df, self.transform_workers,
+                                                              median=median, distinct=distinct)
+                else:
+                    partials = self.compute_partials(df, median=median, distinct=distinct)
+                result = self.transform_partials(partials, rollups=rollups)
+                logger.info("Survey data transformed successfully")
+                return result
         except Exception as e:
             logger.error(f"Error transforming survey data: {str(e)}")
             raise